@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Measures throughput of a running server under concurrent requests.
+
+Requests API endpoints from increasing amount of client threads and reports
+requests per second, median and 99th percentile latency at every level, to
+compare e.g. paste's threaded server with gevent serving mode:
+
+    bin/flask-ctl serve fg        # or: bin/flask-ctl gevent
+    bin/python-console benchmarks/bench_concurrency.py \
+        --append runtime/data/sample_data.csv
+
+With --append a line is appended to the data file every second during the
+run, so the data is reloaded while requests are served.
+
+Usage: bin/python-console benchmarks/bench_concurrency.py [--url URL]
+           [--concurrency 1,10,50,100] [--requests N] [--append data.csv]
+"""
+import sys
+import time
+import urllib2
+import argparse
+import threading
+
+from bench_suite import percentile
+
+
+PATHS = (
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday/10',
+    '/api/v1/presence_start_end/10',
+    '/api/v1/team_weekday',
+    '/api/v1/occupancy',
+)
+
+
+def client(url, paths, amount, timings, errors):
+    """
+    Makes `amount` requests to paths in turn, recording their times.
+    """
+    for i in range(amount):
+        started = time.time()
+        try:
+            urllib2.urlopen(url + paths[i % len(paths)]).read()
+        except (urllib2.URLError, IOError):
+            errors.append(1)
+        else:
+            timings.append(time.time() - started)
+
+
+def run_level(url, paths, concurrency, requests):
+    """
+    Runs `concurrency` clients making `requests` requests in total.
+
+    Returns dict of statistics.
+    """
+    timings = []
+    errors = []
+    per_client = max(1, requests // concurrency)
+    threads = [
+        threading.Thread(target=client,
+                         args=(url, paths, per_client, timings, errors))
+        for i in range(concurrency)
+    ]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    timings.sort()
+    return {
+        'requests': len(timings),
+        'errors': len(errors),
+        'rps': len(timings) / elapsed,
+        'p50': percentile(timings, 0.5) if timings else None,
+        'p99': percentile(timings, 0.99) if timings else None,
+    }
+
+
+def appender(path, stopped):
+    """
+    Appends a line to data file every second until stopped.
+    """
+    second = 0
+    while not stopped.wait(1):
+        with open(path, 'a') as csvfile:
+            csvfile.write('999999,2000-01-03,09:00:%02d,17:00:00\n' % (
+                second % 60))
+        second += 1
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', default='1,10,50,100',
+                        help='comma separated amounts of clients')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests made at every level')
+    parser.add_argument('--append', metavar='CSV',
+                        help='data file of the server to append to')
+    args = parser.parse_args()
+
+    stopped = threading.Event()
+    if args.append:
+        thread = threading.Thread(target=appender,
+                                  args=(args.append, stopped))
+        thread.daemon = True
+        thread.start()
+
+    try:
+        print '%12s %10s %8s %10s %10s' % ('concurrency', 'req/s', 'errors',
+                                           'p50 [s]', 'p99 [s]')
+        for concurrency in [int(level)
+                            for level in args.concurrency.split(',')]:
+            stats = run_level(args.url, PATHS, concurrency, args.requests)
+            print '%12d %10.1f %8d %10.4f %10.4f' % (
+                concurrency, stats['rps'], stats['errors'],
+                stats['p50'] or 0, stats['p99'] or 0,
+            )
+    finally:
+        stopped.set()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
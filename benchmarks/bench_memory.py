@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Compares memory used by nested dicts and columnar presence store.
+
+Each structure is built in a separate process and measured as growth of its
+resident set size (Linux only).
+
+Usage: bin/python-console benchmarks/bench_memory.py [data.csv]
+"""
+import os
+import os.path
+import gc
+import sys
+import subprocess
+
+from presence_analyzer.parser import PresenceParser
+from presence_analyzer.store import PresenceStore
+
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'sample_data.csv'
+)
+
+
+def resident_kb():
+    """
+    Returns resident set size of current process in kilobytes.
+    """
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def build_dict(path):
+    """
+    Builds {user_id: {date: {'start': time, 'end': time}}} structure.
+    """
+    data = {}
+    with open(path, 'r') as csvfile:
+        for user_id, date, start, end in PresenceParser().parse_lines(csvfile):
+            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+    return data
+
+
+BUILDERS = {
+    'dict': build_dict,
+    'store': PresenceStore.from_csv,
+}
+
+
+def measure(name, path):
+    """
+    Prints memory used by structure built with named builder.
+    """
+    gc.collect()
+    before = resident_kb()
+    data = BUILDERS[name](path)
+    gc.collect()
+    print resident_kb() - before
+    return data
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        measure(sys.argv[2], sys.argv[3])
+        return
+
+    path = sys.argv[1] if len(sys.argv) > 1 else SAMPLE_DATA_CSV
+    rows = PresenceStore.from_csv(path).rows()
+    print '%d rows from %s' % (rows, path)
+    for name in sorted(BUILDERS):
+        used = int(subprocess.check_output(
+            [sys.executable, __file__, '--child', name, path]
+        ))
+        print '%-6s %8d kB %8.1f B/row' % (name, used, used * 1024.0 / rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Compares CSV parsing throughput of strptime based and fast parser.
+
+Usage: bin/python-console benchmarks/bench_parsing.py [data.csv] [repeat]
+"""
+import os.path
+import sys
+import csv
+import time
+from datetime import datetime
+
+from presence_analyzer.parser import PresenceParser
+
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'sample_data.csv'
+)
+
+
+def parse_strptime(lines):
+    """
+    Parses lines the way get_data() did before the fast parser.
+    """
+    data = {}
+    for row in csv.reader(lines, delimiter=','):
+        if len(row) != 4:
+            continue
+        try:
+            user_id = int(row[0])
+            date = datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+        except (ValueError, TypeError):
+            continue
+        data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+    return data
+
+
+def parse_fast(lines):
+    """
+    Parses lines with PresenceParser.
+    """
+    data = {}
+    for user_id, date, start, end in PresenceParser().parse_lines(lines):
+        data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+    return data
+
+
+def measure(function, lines, repeat):
+    """
+    Returns best rows per second rate out of `repeat` runs.
+    """
+    best = None
+    for i in range(repeat):
+        started = time.time()
+        function(lines)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    path = sys.argv[1] if len(sys.argv) > 1 else SAMPLE_DATA_CSV
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with open(path, 'r') as csvfile:
+        lines = csvfile.readlines()
+
+    assert parse_strptime(lines) == parse_fast(lines)
+    slow = measure(parse_strptime, lines, repeat)
+    fast = measure(parse_fast, lines, repeat)
+    print '%d lines from %s' % (len(lines), path)
+    print 'strptime: %12.0f rows/s' % slow
+    print 'fast:     %12.0f rows/s (%.1fx)' % (fast, fast / slow)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Compares JSON serialization and compression of API responses.
+
+Results of API views on synthetic data are encoded with json.dumps with
+default settings (the former path of utils.jsonify) and with every
+available encoder of presence_analyzer.serializers, then compressed with
+gzip. Median time of a run and size of the output are reported.
+
+Usage: bin/python-console benchmarks/bench_serialization.py [--users N]
+           [--days N] [--repeat N]
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+from functools import partial
+
+from presence_analyzer import main as presence_main
+from presence_analyzer import views
+from presence_analyzer import serializers
+
+import generate_data
+from bench_suite import measure
+
+
+def payloads(client, user_id):
+    """
+    Returns (url, result) pairs of views to serialize.
+    """
+    urls = [
+        '/api/v1/users',
+        '/api/v1/presence_weekday/%d' % user_id,
+        '/api/v1/batch?user_id=all',
+        '/api/v1/team_weekday',
+        '/api/v1/occupancy',
+    ]
+    return [(url, json.loads(client.get(url).data)) for url in urls]
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'data.csv')
+        with open(path, 'w') as output:
+            generate_data.generate(output, args.users, args.days)
+        app = presence_main.app
+        app.config.update(DATA_CSV=path, RESPONSE_CACHE_SIZE=0)
+        client = app.test_client()
+        user_id = json.loads(client.get('/api/v1/users').data)[0]['user_id']
+        results = payloads(client, user_id)
+    finally:
+        shutil.rmtree(directory)
+
+    header = views.WEEKDAY_HEADER_JSON
+    print '%-40s %-12s %10s %10s' % ('url', 'encoder', 'p50 [ms]',
+                                     'bytes')
+    for url, result in results:
+        if 'presence_weekday' in url:
+            # pre-encoded header row, as presence_weekday_view returns it
+            result = [header] + result[1:]
+            baseline = [json.loads(header.encoded)] + result[1:]
+        else:
+            baseline = result
+        runs = [('default', partial(json.dumps, baseline))]
+        for name, encoder in sorted(serializers.ENCODERS.items()):
+            runs.append((name, partial(serializers.dumps, result, encoder)))
+        for name, function in runs:
+            stats = measure(function, 1, args.repeat)
+            print '%-40s %-12s %10.3f %10d' % (url, name, stats['p50'] * 1000,
+                                               len(function()))
+        body = serializers.dumps(result)
+        stats = measure(lambda: serializers.compress(body, 'gzip'), 1,
+                        args.repeat)
+        print '%-40s %-12s %10.3f %10d' % (
+            url, 'gzip', stats['p50'] * 1000,
+            len(serializers.compress(body, 'gzip')),
+        )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
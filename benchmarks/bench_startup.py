@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Measures startup time of the application.
+
+Every run starts a fresh interpreter, which imports the startup module,
+creates the application with paste app factory (make_app or make_debug)
+and serves the first request, loading the data file. Median time of each
+phase is reported.
+
+With --imports the slowest imports of a single run are listed, like
+`python -X importtime` does on Python 3.7+: `self` is time spent in the
+module itself, `cumulative` includes modules it imports.
+
+Usage: bin/python-console benchmarks/bench_startup.py [--csv data.csv]
+           [--factory make_app|make_debug] [--repeat N] [--imports N]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+import __builtin__
+
+
+DATA_CSV = os.path.join(os.path.dirname(__file__), '..', 'runtime', 'data',
+                        'sample_data.csv')
+
+PHASES = ('import', 'factory', 'first_response', 'total')
+
+
+def trace_imports():
+    """
+    Wraps __import__ to measure time of imports of new modules.
+
+    Returns dict which is filled with {module: [self, cumulative]} times.
+    """
+    original = __builtin__.__import__
+    times = {}
+    children = []
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original(name, *args, **kwargs)
+        started = time.time()
+        children.append(0.0)
+        try:
+            return original(name, *args, **kwargs)
+        finally:
+            nested = children.pop()
+            cumulative = time.time() - started
+            if children:
+                children[-1] += cumulative
+            if name in sys.modules:
+                times[name] = [cumulative - nested, cumulative]
+
+    __builtin__.__import__ = timed_import
+    return times
+
+
+def child(factory, config, imports):
+    """
+    Starts the application once and prints timings as JSON.
+    """
+    times = trace_imports() if imports else None
+    started = time.time()
+    from presence_analyzer import script
+    imported = time.time()
+    wsgi_app = getattr(script, factory)(config=config)
+    created = time.time()
+
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+    response = Client(wsgi_app, BaseResponse).get('/api/v1/users')
+    assert response.status_code == 200, response.status
+    finished = time.time()
+
+    json.dump({
+        'timings': {
+            'import': imported - started,
+            'factory': created - imported,
+            'first_response': finished - created,
+            'total': finished - started,
+        },
+        'imports': times,
+    }, sys.stdout)
+
+
+def run(factory, config, imports=False):
+    """
+    Runs child interpreter and returns its results.
+    """
+    output = subprocess.check_output([
+        sys.executable, __file__, '--child', '--factory', factory,
+        '--config', config,
+    ] + (['--imports', '1'] if imports else []))
+    return json.loads(output)
+
+
+def main():
+    """
+    Runs the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--csv', default=DATA_CSV)
+    parser.add_argument('--factory', default='make_app',
+                        choices=('make_app', 'make_debug'))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--imports', type=int, default=0, metavar='N',
+                        help='list N slowest imports')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.factory, args.config, args.imports)
+
+    # imports the application, which must be measured in child processes
+    from bench_suite import percentile
+
+    fd, config = tempfile.mkstemp(suffix='.cfg')
+    with os.fdopen(fd, 'w') as output:
+        output.write('DATA_CSV = %r\n' % os.path.abspath(args.csv))
+        output.write('DATA_REFRESH_INTERVAL = 0\n')
+    try:
+        timings = dict((phase, []) for phase in PHASES)
+        for i in range(args.repeat):
+            result = run(args.factory, config)
+            for phase in PHASES:
+                timings[phase].append(result['timings'][phase])
+
+        print '%-16s %10s %10s' % ('phase', 'p50 [s]', 'max [s]')
+        for phase in PHASES:
+            values = sorted(timings[phase])
+            print '%-16s %10.4f %10.4f' % (phase, percentile(values, 0.5),
+                                           values[-1])
+
+        if args.imports:
+            times = run(args.factory, config, imports=True)['imports']
+            print
+            print '%-40s %10s %10s' % ('module', 'self [s]', 'cumulative')
+            slowest = sorted(times.iteritems(), key=lambda item: -item[1][0])
+            for name, (own, cumulative) in slowest[:args.imports]:
+                print '%-40s %10.4f %10.4f' % (name, own, cumulative)
+    finally:
+        os.unlink(config)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
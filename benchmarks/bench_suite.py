@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Measures data loading, aggregation helpers and API latency.
+
+Runs every benchmark on a synthetic data file (or a given CSV file) and
+reports throughput, median and 99th percentile time of a run and peak
+resident memory of the process. Results can be saved as JSON and compared
+with results of an earlier run to spot regressions.
+
+Usage: bin/python-console benchmarks/bench_suite.py [--users N] [--days N]
+           [--csv data.csv] [--repeat N] [--output results.json]
+           [--compare baseline.json]
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from presence_analyzer import main as presence_main
+from presence_analyzer import views  # pylint: disable-msg=W0611
+from presence_analyzer import utils
+
+import generate_data
+
+
+def percentile(timings, fraction):
+    """
+    Returns percentile of sorted timings with nearest rank method.
+    """
+    rank = max(1, int(math.ceil(fraction * len(timings))))
+    return timings[rank - 1]
+
+
+def measure(function, items, repeat):
+    """
+    Runs function `repeat` times and returns dict of statistics.
+
+    Throughput is given as amount of items processed per second of median
+    run, peak memory is the highest resident set size of the process so far.
+    """
+    timings = []
+    for i in range(repeat):
+        started = time.time()
+        function()
+        timings.append(time.time() - started)
+    timings.sort()
+    p50 = percentile(timings, 0.5)
+    return {
+        'runs': repeat,
+        'items': items,
+        'p50': p50,
+        'p99': percentile(timings, 0.99),
+        'throughput': items / p50 if p50 else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def benchmarks(path, repeat):
+    """
+    Yields (name, statistics) pairs of all benchmarks.
+    """
+    app = presence_main.app
+    app.config.update(DATA_CSV=path, RESPONSE_CACHE_SIZE=0)
+
+    def load():
+        utils.DATASETS.clear()
+        utils.get_store()
+
+    load()
+    store = utils.get_store()
+    rows = store.rows()
+    users = [store[user_id] for user_id in store.user_ids()]
+    yield 'load', measure(load, rows, repeat)
+    yield 'get_data', measure(utils.get_data, rows, repeat)
+    yield 'group_by_weekday', measure(
+        lambda: [utils.group_by_weekday(user) for user in users],
+        rows, repeat,
+    )
+    yield 'group_by_weekday_start_end', measure(
+        lambda: [utils.group_by_weekday_start_end(user) for user in users],
+        rows, repeat,
+    )
+
+    client = app.test_client()
+    user_id = store.user_ids()[0]
+    endpoints = [
+        '/api/v1/users',
+        '/api/v1/mean_time_weekday/%d' % user_id,
+        '/api/v1/presence_weekday/%d' % user_id,
+        '/api/v1/presence_start_end/%d' % user_id,
+        '/api/v1/batch?user_id=all',
+        '/api/v1/team_weekday',
+        '/api/v1/occupancy',
+        '/api/v1/presence_percentiles',
+        '/api/v1/export.csv?user_id=%d' % user_id,
+    ]
+    for url in endpoints:
+        def request():
+            response = client.get(url)
+            assert response.status_code == 200, url
+            response.get_data()
+        yield url, measure(request, 1, repeat)
+
+
+def compare(results, baseline):
+    """
+    Prints ratio of median times of current and baseline results.
+    """
+    print
+    print '%-48s %10s %10s %8s' % ('benchmark', 'baseline', 'current',
+                                   'ratio')
+    for name, current in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50']
+        print '%-48s %10.4f %10.4f %7.2fx' % (
+            name, before, current['p50'],
+            current['p50'] / before if before else float('inf'),
+        )
+
+
+def main():
+    """
+    Runs the benchmarks.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--csv', help='use existing file instead of '
+                                      'generating one')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--compare', help='JSON results of earlier run')
+    args = parser.parse_args()
+
+    directory = None
+    path = args.csv
+    if path is None:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'data.csv')
+        with open(path, 'w') as output:
+            generate_data.generate(output, args.users, args.days)
+
+    try:
+        results = {}
+        print '%-48s %10s %10s %14s %10s' % ('benchmark', 'p50 [s]',
+                                            'p99 [s]', 'items/s',
+                                            'peak [kB]')
+        for name, stats in benchmarks(path, args.repeat):
+            results[name] = stats
+            print '%-48s %10.4f %10.4f %14.0f %10d' % (
+                name, stats['p50'], stats['p99'], stats['throughput'] or 0,
+                stats['peak_rss_kb'],
+            )
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'meta': {
+                    'csv': args.csv,
+                    'users': args.users,
+                    'days': args.days,
+                    'rows': results['load']['items'],
+                    'python': platform.python_version(),
+                    'numpy': numpy.__version__ if numpy else None,
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                },
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline)['results'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
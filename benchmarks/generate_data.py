@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic presence CSV files.
+
+Every user is present on working days with some absences, arriving around
+9:00 and staying about 8 hours, so files have shape of real data.
+
+Usage: bin/python-console benchmarks/generate_data.py output.csv
+           [users] [days] [seed]
+"""
+import sys
+import random
+from datetime import date, timedelta
+
+
+FIRST_DAY = date(2010, 1, 4)
+ABSENCE = 0.05
+
+
+def _format(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def generate(output, users, days, seed=0):
+    """
+    Writes presence of users during given amount of days to a file object.
+
+    Returns amount of written rows.
+    """
+    rng = random.Random(seed)
+    rows = 0
+    for user_id in xrange(1, users + 1):
+        arrival = rng.gauss(9 * 3600, 1800)
+        lines = []
+        for offset in xrange(days):
+            day = FIRST_DAY + timedelta(days=offset)
+            if day.weekday() > 4 or rng.random() < ABSENCE:
+                continue
+            start = int(min(max(rng.gauss(arrival, 900), 0), 16 * 3600))
+            end = int(min(start + rng.gauss(8 * 3600, 1800), 86399))
+            lines.append('%d,%s,%s,%s\n' % (user_id, day.isoformat(),
+                                            _format(start), _format(end)))
+        output.writelines(lines)
+        rows += len(lines)
+    return rows
+
+
+def main():
+    """
+    Generates the file.
+    """
+    if len(sys.argv) < 2:
+        print __doc__.strip()
+        sys.exit(1)
+    path = sys.argv[1]
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 365
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    with open(path, 'w') as output:
+        rows = generate(output, users, days, seed)
+    print '%d rows written to %s' % (rows, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,11 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'gevent': ['gevent'],
+        'ujson': ['ujson'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Weekday aggregation of presence entries.
+
+Uses NumPy when it is installed and falls back to pure Python otherwise.
+"""
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+WEEKDAYS = 7
+
+
+def weekday(day):
+    """
+    Returns weekday number (0 is Monday) of a day ordinal, or of NumPy
+    array of them.
+    """
+    # ordinal 1 (0001-01-01) was a Monday
+    return (day - 1) % WEEKDAYS
+
+
+def _mean(total, count):
+    """
+    Calculates arithmetic mean from sum and amount of items.
+    """
+    return float(total) / count if count > 0 else 0.0
+
+
+class WeekdaySummary(object):
+    """
+    Per weekday amount of entries and sums of their start and end times.
+
+    Everything else (presence totals and means) is derived from these three
+    lists indexed by weekday number (0 is Monday).
+    """
+    __slots__ = ('counts', 'start_totals', 'end_totals')
+
+    def __init__(self, counts=None, start_totals=None, end_totals=None):
+        self.counts = counts or [0] * WEEKDAYS
+        self.start_totals = start_totals or [0] * WEEKDAYS
+        self.end_totals = end_totals or [0] * WEEKDAYS
+
+    def __eq__(self, other):
+        return (self.counts == other.counts and
+                self.start_totals == other.start_totals and
+                self.end_totals == other.end_totals)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return WeekdaySummary(
+            [a + b for a, b in zip(self.counts, other.counts)],
+            [a + b for a, b in zip(self.start_totals, other.start_totals)],
+            [a + b for a, b in zip(self.end_totals, other.end_totals)],
+        )
+
+    def totals(self):
+        """
+        Returns total presence time in seconds per weekday.
+        """
+        return [end - start
+                for start, end in zip(self.start_totals, self.end_totals)]
+
+    def mean_intervals(self):
+        """
+        Returns mean presence time in seconds per weekday.
+        """
+        return [_mean(total, count)
+                for total, count in zip(self.totals(), self.counts)]
+
+    def mean_starts(self):
+        """
+        Returns mean start of presence in seconds per weekday.
+        """
+        return [_mean(total, count)
+                for total, count in zip(self.start_totals, self.counts)]
+
+    def mean_ends(self):
+        """
+        Returns mean end of presence in seconds per weekday.
+        """
+        return [_mean(total, count)
+                for total, count in zip(self.end_totals, self.counts)]
+
+
+def _summarize_python(user):
+    """
+    Aggregates entries of single user in pure Python.
+    """
+    summary = WeekdaySummary()
+    counts = summary.counts
+    start_totals = summary.start_totals
+    end_totals = summary.end_totals
+    for day, start, end in zip(user.days, user.starts, user.ends):
+        index = weekday(day)
+        counts[index] += 1
+        start_totals[index] += start
+        end_totals[index] += end
+    return summary
+
+
+def column(values):
+    """
+    Returns NumPy view of an integer column without copying it if possible.
+    """
+    if isinstance(values, numpy.ndarray):
+        return values
+    if not len(values):
+        return numpy.zeros(0, dtype=numpy.int32)
+    return numpy.frombuffer(values, dtype=numpy.int32)
+
+
+def _summarize_numpy(users):
+    """
+    Aggregates entries of many users in one batch of NumPy operations.
+    """
+    lengths = [len(user) for user in users]
+    days = numpy.concatenate([column(user.days) for user in users])
+    starts = numpy.concatenate([column(user.starts) for user in users])
+    ends = numpy.concatenate([column(user.ends) for user in users])
+
+    # every (user, weekday) pair gets its own bin
+    size = len(users) * WEEKDAYS
+    keys = numpy.repeat(numpy.arange(len(users)) * WEEKDAYS, lengths)
+    keys += weekday(days)
+    counts = numpy.bincount(keys, minlength=size)
+    start_totals = numpy.bincount(keys, weights=starts, minlength=size)
+    end_totals = numpy.bincount(keys, weights=ends, minlength=size)
+
+    shape = (len(users), WEEKDAYS)
+    counts = counts.reshape(shape).tolist()
+    start_totals = start_totals.astype(numpy.int64).reshape(shape).tolist()
+    end_totals = end_totals.astype(numpy.int64).reshape(shape).tolist()
+    return [
+        WeekdaySummary(*columns)
+        for columns in zip(counts, start_totals, end_totals)
+    ]
+
+
+def summarize_many(users, use_numpy=True):
+    """
+    Aggregates entries of many users by weekday in a single pass.
+
+    Takes {user_id: UserPresence} dict and returns {user_id: WeekdaySummary}.
+    """
+    user_ids = list(users)
+    if not user_ids:
+        return {}
+    if numpy is None or not use_numpy:
+        return {
+            user_id: _summarize_python(users[user_id])
+            for user_id in user_ids
+        }
+    summaries = _summarize_numpy([users[user_id] for user_id in user_ids])
+    return dict(zip(user_ids, summaries))
+
+
+def summarize(user, use_numpy=True):
+    """
+    Aggregates entries of single user by weekday.
+    """
+    return summarize_many({None: user}, use_numpy)[None]
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+In-process caches shared by request threads.
+"""
+import os
+import time
+import threading
+import itertools
+from collections import namedtuple, OrderedDict
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+CacheEntry = namedtuple('CacheEntry', ['signature', 'value', 'generation'])
+
+# numbers of loaded entries, increasing with every (re)load in the process
+_generations = itertools.count(1)
+
+
+def file_signature(path):
+    """
+    Returns (mtime, size) pair identifying current version of a file.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+class DatasetCache(object):
+    """
+    Thread-safe cache of datasets parsed from files.
+
+    Entries are keyed by file path and reloaded only when modification time
+    or size of the file changes. Concurrent requests for a stale entry wait
+    for a single reload instead of parsing the file on their own.
+
+    Optional updater is called with stale dataset and path to refresh it
+    incrementally; when it returns None the file is loaded from scratch.
+
+    Paths added to `watched` are kept up to date by a background thread
+    calling refresh(), so readers get their cached entries without checking
+    the file.
+
+    Versions of files are told apart with `signature` function, which may
+    be replaced to track e.g. directories of files. Every (re)loaded entry
+    gets a higher `generation`, so entries can be ordered even when file
+    modification times move backwards.
+
+    Reloads run directly, unless executor is set with set_executor(); it
+    is called with the function and tuple of its arguments and returns its
+    result, e.g. to load datasets in a pool of threads.
+    """
+
+    def __init__(self, loader, updater=None, signature=file_signature):
+        self.loader = loader
+        self.updater = updater
+        self.signature = signature
+        self.executor = None
+        self.watched = set()
+        self.load_times = {}
+        self._entries = {}
+        self._locks = {}
+        self._lock_type = threading.Lock
+        self._lock = threading.Lock()
+
+    def set_executor(self, executor, lock_type=threading.Lock):
+        """
+        Makes reloads run with executor.
+
+        Whole reloads, including waiting for locks of paths, run in the
+        executor, so locks are only taken by its threads and have to be
+        created with `lock_type` of the threads it uses. It has to be set
+        before the cache is used.
+        """
+        self.executor = executor
+        self._lock_type = lock_type
+        self._lock = lock_type()
+        self._locks = {}
+
+    def _path_lock(self, path):
+        """
+        Returns lock guarding reloads of given path.
+        """
+        with self._lock:
+            lock = self._locks.get(path)
+            if lock is None:
+                lock = self._locks[path] = self._lock_type()
+            return lock
+
+    def get(self, path):
+        """
+        Returns dataset loaded from path, reloading it if file has changed.
+        """
+        return self.get_entry(path).value
+
+    def get_entry(self, path):
+        """
+        Returns CacheEntry of path, reloading it if file has changed.
+        """
+        entry = self._entries.get(path)
+        if entry is not None and (path in self.watched or
+                                  entry.signature == self.signature(path)):
+            return entry
+        return self.refresh(path)
+
+    def refresh(self, path):
+        """
+        Reloads dataset of path if file has changed and returns its
+        CacheEntry.
+
+        New entry replaces the old one at once, readers never see partially
+        loaded datasets.
+        """
+        if self.executor is None:
+            return self._refresh(path)
+        return self.executor(self._refresh, (path,))
+
+    def _refresh(self, path):
+        """
+        Reloads dataset of path in current thread.
+        """
+        with self._path_lock(path):
+            # other thread might have reloaded the file while we were waiting
+            signature = self.signature(path)
+            entry = self._entries.get(path)
+            if entry is not None and entry.signature == signature:
+                return entry
+
+            value = None
+            if entry is not None and self.updater is not None:
+                log.debug('Updating dataset from %s', path)
+                value = self.updater(entry.value, path)
+            if value is None:
+                log.debug('Loading dataset from %s', path)
+                value = self.loader(path)
+            entry = CacheEntry(signature, value, next(_generations))
+            self._entries[path] = entry
+            self.load_times[path] = time.time()
+        return entry
+
+    def clear(self):
+        """
+        Drops all cached datasets.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.load_times.clear()
+
+    def retain(self, paths):
+        """
+        Drops cached datasets of paths other than given ones.
+        """
+        paths = set(paths)
+        with self._lock:
+            for path in list(self._entries):
+                if path not in paths:
+                    del self._entries[path]
+                    self.load_times.pop(path, None)
+                    self.watched.discard(path)
+
+
+class ResponseCache(object):
+    """
+    Thread-safe LRU cache of serialized responses.
+
+    Cache is bounded both by amount of entries and their total size in bytes.
+    Every entry belongs to a dataset version, (path, generation) pair of
+    CacheEntry loaded by DatasetCache. Storing or looking up an entry of a
+    newer version drops all entries of the current one; entries of older
+    versions, used by requests which started before the dataset was
+    reloaded, are neither stored nor looked up.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _set_version(self, version):
+        """
+        Drops entries of current version when given version replaces it.
+
+        Returns False for versions older than the current one.
+        """
+        if version == self.version:
+            return True
+        if (self.version is not None and version[0] == self.version[0] and
+                version[1] < self.version[1]):
+            return False
+        self._entries.clear()
+        self.size = 0
+        self.version = version
+        return True
+
+    def get(self, key, version):
+        """
+        Returns cached value or None.
+        """
+        with self._lock:
+            if self._set_version(version):
+                value = self._entries.pop(key, None)
+            else:
+                value = None
+            if value is None:
+                self.misses += 1
+                return None
+            # move entry to the end, it is the most recently used now
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version):
+        """
+        Stores value, evicting least recently used entries over the limits.
+        """
+        if len(value) > self.max_bytes or self.max_entries < 1:
+            return
+        with self._lock:
+            if not self._set_version(version):
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while (len(self._entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                __, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        """
+        Drops all entries and resets counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        Returns dict with cache usage counters.
+        """
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage of presence data.
+
+Database has single `presence` table with one row per user and day. Day is
+stored as date ordinal along with precomputed weekday, start and end as
+seconds since midnight, so weekday aggregation is done by SQLite with
+GROUP BY using indexes instead of loading all rows into Python.
+"""
+import sqlite3
+import threading
+
+from presence_analyzer.files import atomic_write
+from presence_analyzer.parser import PresenceParser
+from presence_analyzer.partitions import partition_paths
+from presence_analyzer.store import UserPresence
+from presence_analyzer.aggregates import WeekdaySummary, weekday
+from presence_analyzer.quantiles import sketch_many
+
+
+SCHEMA = (
+    '''
+    CREATE TABLE presence (
+        user_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        weekday INTEGER NOT NULL,
+        start INTEGER NOT NULL,
+        "end" INTEGER NOT NULL,
+        PRIMARY KEY (user_id, day)
+    )
+    ''',
+)
+
+# created after rows are inserted, which is faster than updating them
+INDEXES = (
+    'CREATE INDEX presence_day ON presence (day)',
+    'CREATE INDEX presence_user_weekday ON presence '
+    '(user_id, weekday, start, "end")',
+)
+
+# SQLite limits amount of parameters of a query to 999
+BATCH_SIZE = 500
+
+
+def _rows(records):
+    """
+    Yields table rows of (user_id, day, start, end) records.
+    """
+    for user_id, day, start, end in records:
+        yield user_id, day, weekday(day), start, end
+
+
+def _parse_files(paths):
+    """
+    Yields (user_id, day, start, end) records of CSV files.
+    """
+    parser = PresenceParser()
+    for csv_path in paths:
+        with open(csv_path, 'rb') as csvfile:
+            for record in parser.parse_records(csvfile):
+                yield record
+
+
+def build_database(csv_path, path):
+    """
+    Creates database of presence entries from CSV file, or from all
+    partition files of a directory or glob pattern.
+
+    Later entries for the same user and day replace earlier ones, as they
+    do in PresenceStore; partitions are read in order of their names.
+    """
+    paths = partition_paths(csv_path)
+    if paths is None:
+        paths = [csv_path]
+    write_database(_parse_files(paths), path)
+
+
+def write_database(records, path):
+    """
+    Creates database of (user_id, day, start, end) records.
+    """
+    with atomic_write(path) as tmp_path:
+        connection = sqlite3.connect(tmp_path)
+        try:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+                connection.executemany(
+                    'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)',
+                    _rows(records),
+                )
+                for statement in INDEXES:
+                    connection.execute(statement)
+            connection.execute('ANALYZE')
+        finally:
+            connection.close()
+
+
+def _where(first, last, user_ids=None):
+    """
+    Returns WHERE clause and parameters selecting entries of given users
+    between day ordinals.
+    """
+    conditions = []
+    params = []
+    if user_ids is not None:
+        conditions.append('user_id IN ({0})'.format(
+            ', '.join('?' * len(user_ids))
+        ))
+        params.extend(user_ids)
+    if first is not None:
+        conditions.append('day >= ?')
+        params.append(first)
+    if last is not None:
+        conditions.append('day <= ?')
+        params.append(last)
+    if not conditions:
+        return '', params
+    return ' WHERE ' + ' AND '.join(conditions), params
+
+
+class SqliteStore(object):
+    """
+    Presence data of all users, read from SQLite database.
+
+    Provides the same interface as PresenceStore, but entries are read only
+    when needed and weekday summaries are computed by SQLite. Every thread
+    uses its own connection.
+
+    Queries run directly, unless `executor` is given; it is called with the
+    function and tuple of its arguments and returns its result, like
+    executor of DatasetCache.
+    """
+
+    def __init__(self, path, executor=None):
+        self.path = path
+        self.executor = executor
+        self._local = threading.local()
+
+    def _fetch(self, query, params):
+        """
+        Returns all rows of query run in connection of current thread.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+        return connection.execute(query, params).fetchall()
+
+    def _execute(self, query, params=()):
+        """
+        Executes query with executor, if any, and returns list of its rows.
+        """
+        if self.executor is None:
+            return self._fetch(query, params)
+        return self.executor(self._fetch, (query, params))
+
+    def __contains__(self, user_id):
+        return bool(self._execute(
+            'SELECT 1 FROM presence WHERE user_id = ? LIMIT 1', (user_id,)
+        ))
+
+    def __getitem__(self, user_id):
+        user = self.users_of([user_id])[user_id]
+        if not len(user):
+            raise KeyError(user_id)
+        return user
+
+    def __len__(self):
+        return self._execute(
+            'SELECT COUNT(DISTINCT user_id) FROM presence'
+        )[0][0]
+
+    def user_ids(self, first=None, last=None):
+        """
+        Returns sorted list of user ids.
+
+        When day ordinals are given, only users present between them
+        are returned.
+        """
+        where, params = _where(first, last)
+        return [user_id for user_id, in self._execute(
+            'SELECT DISTINCT user_id FROM presence' + where +
+            ' ORDER BY user_id', params
+        )]
+
+    def known_user_ids(self, user_ids):
+        """
+        Returns given user ids which have entries, in the same order.
+        """
+        user_ids = list(user_ids)
+        known = set()
+        for batch in xrange(0, len(user_ids), BATCH_SIZE):
+            where, params = _where(None, None,
+                                   user_ids[batch:batch + BATCH_SIZE])
+            known.update(user_id for user_id, in self._execute(
+                'SELECT DISTINCT user_id FROM presence' + where, params
+            ))
+        return [user_id for user_id in user_ids if user_id in known]
+
+    def users_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: UserPresence} dict of entries of given users
+        between day ordinals.
+        """
+        users = {user_id: UserPresence() for user_id in user_ids}
+        user_ids = list(users)
+        for batch in xrange(0, len(user_ids), BATCH_SIZE):
+            where, params = _where(first, last,
+                                   user_ids[batch:batch + BATCH_SIZE])
+            for user_id, day, start, end in self._execute(
+                    'SELECT user_id, day, start, "end" FROM presence' +
+                    where + ' ORDER BY user_id, day', params):
+                user = users[user_id]
+                user.days.append(day)
+                user.starts.append(start)
+                user.ends.append(end)
+        return users
+
+    def summary(self, user_id, first=None, last=None):
+        """
+        Returns WeekdaySummary of given user.
+
+        Summary is limited to entries between given day ordinals, if any.
+        """
+        return self.summaries_of([user_id], first, last)[user_id]
+
+    def summaries_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: WeekdaySummary} dict of given users, aggregated
+        by SQLite.
+        """
+        result = {user_id: WeekdaySummary() for user_id in user_ids}
+        user_ids = list(result)
+        for batch in xrange(0, len(user_ids), BATCH_SIZE):
+            where, params = _where(first, last,
+                                   user_ids[batch:batch + BATCH_SIZE])
+            for user_id, index, count, starts, ends in self._execute(
+                    'SELECT user_id, weekday, COUNT(*), SUM(start), '
+                    'SUM("end") FROM presence' + where +
+                    ' GROUP BY user_id, weekday', params):
+                summary = result[user_id]
+                summary.counts[index] = count
+                summary.start_totals[index] = starts
+                summary.end_totals[index] = ends
+        return result
+
+    def quantiles_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: WeekdayQuantiles} dict of given users.
+        """
+        return sketch_many(self.users_of(user_ids, first, last))
+
+    def rows(self):
+        """
+        Returns total number of stored entries.
+        """
+        return self._execute('SELECT COUNT(*) FROM presence')[0][0]
+
+    def to_dict(self):
+        """
+        Returns data in structure returned by utils.get_data().
+        """
+        return {
+            user_id: user.to_dict()
+            for user_id, user in self.users_of(self.user_ids()).iteritems()
+        }
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Writing data files next to their readers.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, prefix='tmp'):
+    """
+    Yields path of a temporary file in directory of `path`, which replaces
+    `path` once the block completes.
+
+    Readers never see partially written files. Temporary file is removed
+    when the block fails.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix,
+                                    dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
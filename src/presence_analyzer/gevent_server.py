@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Serving the application with gevent.
+
+Every request is handled by a greenlet instead of a thread of paste's
+pool, so amount of concurrent connections is not limited by pool size.
+Greenlets run in a single thread and must not block it: loading and
+updating datasets, partitions loaded by requests and queries of SQLite
+databases are run in gevent's pool of native threads, while requests are
+served from datasets already loaded.
+
+gevent is optional, install it with `presence_analyzer[gevent]`. Standard
+library has to be patched with patch() before the application is imported,
+so its locks and the background refresher cooperate with greenlets.
+"""
+try:
+    import gevent
+    import gevent.monkey
+    import gevent.pool
+    import gevent.pywsgi
+except ImportError:
+    gevent = None  # pylint: disable-msg=C0103
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def available():
+    """
+    Checks if gevent is installed.
+    """
+    return gevent is not None
+
+
+def patch():
+    """
+    Patches standard library to cooperate with greenlets.
+    """
+    if gevent is None:
+        raise RuntimeError('gevent is not installed')
+    gevent.monkey.patch_all()
+
+
+def in_threadpool(function, args):
+    """
+    Calls function with given arguments in gevent's pool of native threads,
+    blocking only the calling greenlet.
+
+    Calls made from threads of the pool run immediately in the same thread.
+    """
+    return gevent.get_hub().threadpool.apply(function, args)
+
+
+def offload_loading(caches):
+    """
+    Makes DatasetCaches load and update their datasets in gevent's pool of
+    threads. SQLite stores loaded by DATASETS run their queries there too.
+
+    Caches guard reloads with locks of native threads, as patched locks
+    cannot be shared by greenlets and threads of the pool.
+    """
+    lock_type = gevent.monkey.get_original('thread', 'allocate_lock')
+    for cache in caches:
+        cache.set_executor(in_threadpool, lock_type)
+
+
+def serve(app, host, port, connections):
+    """
+    Serves WSGI application until interrupted, handling at most
+    `connections` requests at once.
+    """
+    server = gevent.pywsgi.WSGIServer(
+        (host, port), app,
+        spawn=gevent.pool.Pool(connections),
+        log=logging.getLogger('wsgi'),
+        error_log=log,
+    )
+    log.info('Serving on http://%s:%s with gevent', host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk import of large presence CSV files.
+
+File is split into chunks at line boundaries, chunks are parsed by a pool
+of worker processes and their entries merged in file order. Entries of the
+same user and day are resolved by one of CONFLICT_RULES.
+"""
+import os
+import multiprocessing
+from array import array
+
+from presence_analyzer.parser import PresenceParser
+from presence_analyzer.store import (PresenceStore, UserPresence, CsvSource,
+                                     TYPECODE, TAIL_SIZE)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class DuplicateEntryError(ValueError):
+    """
+    Raised when the same user and day is found twice and duplicates are not
+    allowed.
+    """
+
+
+def _raise_duplicate(entries):
+    """
+    Refuses to choose between entries of the same day.
+    """
+    raise DuplicateEntryError('{0} entries of the same day'.format(
+        len(entries)
+    ))
+
+
+# functions choosing one of (start, end) entries of the same day, given in
+# file order
+CONFLICT_RULES = {
+    'last': lambda entries: entries[-1],
+    'first': lambda entries: entries[0],
+    'longest': lambda entries: max(reversed(entries),
+                                   key=lambda entry: entry[1] - entry[0]),
+    'error': _raise_duplicate,
+}
+
+
+def split(path, chunk_size=CHUNK_SIZE, size=None):
+    """
+    Returns (start, end) byte offsets of chunks of first `size` bytes of
+    file (the whole file by default) ending at line boundaries.
+    """
+    if size is None:
+        size = os.path.getsize(path)
+    chunks = []
+    with open(path, 'rb') as csvfile:
+        start = 0
+        while start < size:
+            csvfile.seek(min(start + chunk_size, size) - 1)
+            csvfile.readline()
+            end = min(csvfile.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def parse_chunk(job):
+    """
+    Parses chunk of CSV file.
+
+    Takes (path, start, end) tuple and returns {user_id: (days, starts,
+    ends)} dict of arrays in file order.
+    """
+    path, chunk_start, chunk_end = job
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(chunk_start)
+        lines = csvfile.read(chunk_end - chunk_start).splitlines(True)
+
+    columns = {}
+    for user_id, day, start, end in PresenceParser().parse_records(lines):
+        try:
+            days, starts, ends = columns[user_id]
+        except KeyError:
+            days, starts, ends = columns[user_id] = (
+                array(TYPECODE), array(TYPECODE), array(TYPECODE)
+            )
+        days.append(day)
+        starts.append(start)
+        ends.append(end)
+    return columns
+
+
+def resolve(days, starts, ends, rule='last'):
+    """
+    Creates UserPresence from arrays in file order, resolving entries of
+    the same day with given conflict rule.
+
+    Returns (user, duplicates) tuple, where duplicates is amount of
+    dropped entries.
+    """
+    if all(days[i] < days[i + 1] for i in xrange(len(days) - 1)):
+        return UserPresence(days, starts, ends), 0
+
+    choose = CONFLICT_RULES[rule]
+    entries = {}
+    for day, start, end in zip(days, starts, ends):
+        entries.setdefault(day, []).append((start, end))
+    user = UserPresence()
+    for day in sorted(entries):
+        start, end = choose(entries[day])
+        user.days.append(day)
+        user.starts.append(start)
+        user.ends.append(end)
+    return user, len(days) - len(user)
+
+
+def _source(path):
+    """
+    Returns CsvSource of complete lines of a file.
+
+    File size is taken once, content appended later is left for
+    update_from_csv().
+    """
+    with open(path, 'rb') as csvfile:
+        stat = os.fstat(csvfile.fileno())
+        offset = stat.st_size
+        if offset:
+            csvfile.seek(offset - 1)
+            if csvfile.read(1) != '\n':
+                # unterminated last line is not a part of loaded content
+                csvfile.seek(max(0, offset - CHUNK_SIZE))
+                head = csvfile.read(offset - csvfile.tell())
+                offset -= len(head) - head.rfind('\n') - 1
+        start = max(0, offset - TAIL_SIZE)
+        csvfile.seek(start)
+        return CsvSource(stat.st_ino, stat.st_size, offset,
+                         csvfile.read(offset - start))
+
+
+def import_csv(path, rule='last', processes=None, chunk_size=CHUNK_SIZE,
+               index=True):
+    """
+    Loads PresenceStore from CSV file parsing its chunks in parallel.
+
+    Returns (store, duplicates) tuple, where duplicates is amount of
+    entries dropped by conflict rule. Pool of `processes` workers (all
+    CPUs by default) is used when the file has more than one chunk.
+    Summaries and sketches of users are built only with `index`, stores
+    written to a database do not need them.
+    """
+    if rule not in CONFLICT_RULES:
+        raise ValueError('Unknown conflict rule: {0}'.format(rule))
+    source = _source(path)
+    jobs = [(path, start, end)
+            for start, end in split(path, chunk_size, source.size)]
+    pool = None
+    if len(jobs) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        parsed = pool.imap(parse_chunk, jobs)
+    else:
+        parsed = (parse_chunk(job) for job in jobs)
+
+    try:
+        columns = {}
+        for chunk in parsed:
+            for user_id, user_columns in chunk.iteritems():
+                if user_id not in columns:
+                    columns[user_id] = user_columns
+                else:
+                    for merged, column in zip(columns[user_id],
+                                              user_columns):
+                        merged.extend(column)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    users = {}
+    duplicates = 0
+    for user_id, user_columns in columns.iteritems():
+        try:
+            users[user_id], dropped = resolve(*user_columns, rule=rule)
+        except DuplicateEntryError as error:
+            raise DuplicateEntryError('User {0}: {1}'.format(user_id, error))
+        duplicates += dropped
+
+    store = PresenceStore(users)
+    if index:
+        store.build_index()
+    store.source = source
+    return store, duplicates
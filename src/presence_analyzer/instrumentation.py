@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Request timing, metrics and profiling.
+
+Time spent in phases of a request (loading data, aggregation and
+serialization) is reported in Server-Timing header of the response and
+collected in per endpoint histograms exposed in Prometheus text format.
+
+Requests can also be profiled with cProfile: when PROFILE_DIR is set,
+profiles of requests with `profile` query parameter (or of all requests,
+when PROFILE_ALL is enabled) are dumped there.
+"""
+import os
+import time
+import cProfile
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from flask import g, request, has_request_context
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in fixed buckets.
+    """
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        # the last bucket counts values above all bounds
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Counts a value.
+        """
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Histograms(object):
+    """
+    Thread-safe collection of histograms identified by label values.
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, values, value):
+        """
+        Counts a value in histogram of given label values.
+        """
+        with self._lock:
+            histogram = self.histograms.get(values)
+            if histogram is None:
+                histogram = self.histograms[values] = Histogram()
+            histogram.observe(value)
+
+    def clear(self):
+        """
+        Drops all histograms.
+        """
+        with self._lock:
+            self.histograms.clear()
+
+    def render(self, name, description):
+        """
+        Returns histograms as lines of Prometheus text format.
+        """
+        lines = [
+            '# HELP {0} {1}'.format(name, description),
+            '# TYPE {0} histogram'.format(name),
+        ]
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            for values, histogram in histograms:
+                labels = ','.join(
+                    '{0}="{1}"'.format(label, _escape(value))
+                    for label, value in zip(self.labels, values)
+                )
+                cumulative = 0
+                bounds = [repr(bound) for bound in BUCKETS] + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        name, labels, bound, cumulative
+                    ))
+                lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                    name, labels, histogram.total
+                ))
+                lines.append('{0}_count{{{1}}} {2}'.format(
+                    name, labels, histogram.count
+                ))
+        return lines
+
+
+def _escape(value):
+    """
+    Escapes label value for Prometheus text format.
+    """
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+REQUEST_TIMES = Histograms(('endpoint', 'phase'))
+
+
+@contextmanager
+def timed(phase):
+    """
+    Measures time spent in a phase of current request.
+
+    Times of phases entered many times are summed up.
+    """
+    started = default_timer()
+    try:
+        yield
+    finally:
+        if has_request_context() and 'timings' in g:
+            g.timings[phase] = (g.timings.get(phase, 0.0) +
+                                default_timer() - started)
+
+
+def _profile_requested():
+    """
+    Checks if current request should be profiled.
+    """
+    return bool(app.config.get('PROFILE_DIR')) and (
+        app.config.get('PROFILE_ALL') or 'profile' in request.args
+    )
+
+
+def _dump_profile(profiler):
+    """
+    Saves profile of current request to PROFILE_DIR.
+    """
+    directory = app.config['PROFILE_DIR']
+    path = os.path.join(directory, '{0}-{1}-{2}.prof'.format(
+        request.endpoint or 'unknown', int(time.time() * 1000), os.getpid()
+    ))
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        profiler.dump_stats(path)
+    except (IOError, OSError):
+        log.warning('Cannot write profile %s', path, exc_info=True)
+    else:
+        log.info('Profile of %s written to %s', request.path, path)
+
+
+@app.before_request
+def start_request_timing():
+    """
+    Starts measuring time of a request, profiling it if requested.
+    """
+    g.timings = OrderedDict()
+    g.request_started = default_timer()
+    if _profile_requested():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def finish_request_timing(response):
+    """
+    Records request timings and sets Server-Timing header.
+    """
+    if 'request_started' not in g:
+        return response
+    total = default_timer() - g.request_started
+    profiler = g.get('profiler')
+    if profiler is not None:
+        profiler.disable()
+        _dump_profile(profiler)
+
+    phases = g.timings.items() + [('total', total)]
+    endpoint = request.endpoint or 'unknown'
+    for phase, seconds in phases:
+        REQUEST_TIMES.observe((endpoint, phase), seconds)
+    response.headers['Server-Timing'] = ', '.join(
+        '{0};dur={1:.3f}'.format(phase, seconds * 1000)
+        for phase, seconds in phases
+    )
+    return response
+
+
+def render_metrics(cache_stats):
+    """
+    Returns request metrics and response cache counters in Prometheus text
+    format.
+    """
+    lines = REQUEST_TIMES.render(
+        'presence_analyzer_request_duration_seconds',
+        'Time spent in phases of requests.',
+    )
+    for name, kind, description in (
+            ('hits', 'counter', 'Responses served from cache.'),
+            ('misses', 'counter', 'Responses missing in cache.'),
+            ('entries', 'gauge', 'Responses stored in cache.'),
+            ('bytes', 'gauge', 'Size of responses stored in cache.')):
+        metric = 'presence_analyzer_response_cache_' + name
+        if kind == 'counter':
+            metric += '_total'
+        lines.append('# HELP {0} {1}'.format(metric, description))
+        lines.append('# TYPE {0} {1}'.format(metric, kind))
+        lines.append('{0} {1}'.format(metric, cache_stats[name]))
+    return '\n'.join(lines) + '\n'
@@ -9,10 +9,79 @@ from flask import Flask
 MAIN_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
 )
+MAIN_DATA_DB = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'presence.db'
+)
 
 
 app = Flask(__name__)  # pylint: disable-msg=C0103
 app.config.update(
     DEBUG=True,
-    DATA_CSV=MAIN_DATA_CSV
+    DATA_BACKEND='csv',
+    DATA_CSV=MAIN_DATA_CSV,
+    DATA_DB=MAIN_DATA_DB,
+    DATA_SNAPSHOT=False,
+    DATA_REFRESH_INTERVAL=0,
+    API_CACHE_MAX_AGE=0,
+    RESPONSE_CACHE_SIZE=1024,
+    RESPONSE_CACHE_MAX_BYTES=64 * 1024 * 1024,
+    RESPONSE_COMPRESS_MIN_SIZE=None,
+    JSON_ENCODER='json',
+    PROFILE_DIR=None,
+    PROFILE_ALL=False,
+    SERVER_HOST='127.0.0.1',
+    SERVER_PORT=5000,
+    GEVENT_CONNECTIONS=1000,
+    PREFORK_WORKERS=0,
 )
+
+
+def init_db():
+    """
+    Builds SQLite database DATA_DB from DATA_CSV.
+    """
+    from presence_analyzer.database import build_database
+    build_database(app.config['DATA_CSV'], app.config['DATA_DB'])
+
+
+def import_data(path=None, rule='last', processes=None):
+    """
+    Imports CSV file (DATA_CSV by default) into store of DATA_BACKEND.
+
+    Entries are written to DATA_DB database for SQLite backend and to
+    snapshot of the file otherwise. Returns (rows, duplicates, target)
+    tuple: amount of imported and dropped entries and path of written file.
+
+    Path may point to a directory or glob pattern of partition files, each
+    of them is imported on its own. Their snapshots are written next to
+    them and target is the list of their paths; in the database entries of
+    later partitions replace earlier ones of the same user and day.
+    """
+    from itertools import chain
+    from presence_analyzer import snapshot
+    from presence_analyzer.database import write_database
+    from presence_analyzer.importer import import_csv
+    from presence_analyzer.partitions import partition_paths
+    path = path or app.config['DATA_CSV']
+    paths = partition_paths(path)
+    to_database = app.config['DATA_BACKEND'] == 'sqlite'
+    stores = []
+    targets = []
+    rows = duplicates = 0
+    for csv_path in paths if paths is not None else [path]:
+        store, dropped = import_csv(csv_path, rule, processes,
+                                    index=not to_database)
+        rows += store.rows()
+        duplicates += dropped
+        if to_database:
+            stores.append(store)
+        else:
+            targets.append(snapshot.snapshot_path(csv_path))
+            snapshot.write(store, targets[-1], csv_path)
+    if to_database:
+        target = app.config['DATA_DB']
+        write_database(chain.from_iterable(store.records()
+                                           for store in stores), target)
+    else:
+        target = targets if paths is not None else targets[0]
+    return rows, duplicates, target
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Office occupancy in time slots of a day.
+
+Every presence entry adds one to the first slot it overlaps and subtracts one
+right after the last one. Prefix sums of these changes give amount of people
+present in every slot, so cost is linear in amount of entries no matter how
+small slots are.
+"""
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from presence_analyzer.aggregates import WEEKDAYS, column, weekday
+
+
+DAY_SECONDS = 24 * 60 * 60
+DEFAULT_SLOT = 15 * 60
+
+
+class Occupancy(object):
+    """
+    Mergeable occupancy counters of every weekday.
+
+    Keeps per weekday difference arrays of people present in each slot and
+    set of days entries came from, needed to calculate daily means.
+    """
+    __slots__ = ('slot', 'changes', 'days')
+
+    def __init__(self, slot=DEFAULT_SLOT, changes=None, days=None):
+        if DAY_SECONDS % slot:
+            raise ValueError('Slot must divide a day: {0}'.format(slot))
+        self.slot = slot
+        self.changes = changes or [[0] * (self.slots() + 1)
+                                   for i in range(WEEKDAYS)]
+        self.days = days if days is not None else set()
+
+    def __add__(self, other):
+        if other.slot != self.slot:
+            raise ValueError('Cannot merge occupancy of different slots')
+        return Occupancy(
+            self.slot,
+            [[a + b for a, b in zip(mine, others)]
+             for mine, others in zip(self.changes, other.changes)],
+            self.days | other.days,
+        )
+
+    def __eq__(self, other):
+        return (self.slot == other.slot and self.changes == other.changes and
+                self.days == other.days)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def slots(self):
+        """
+        Returns amount of slots in a day.
+        """
+        return DAY_SECONDS // self.slot
+
+    def counts(self):
+        """
+        Returns per weekday lists of total amount of people in every slot.
+        """
+        result = []
+        for changes in self.changes:
+            present = 0
+            counts = []
+            for change in changes[:-1]:
+                present += change
+                counts.append(present)
+            result.append(counts)
+        return result
+
+    def means(self):
+        """
+        Returns per weekday lists of mean amount of people in every slot.
+        """
+        days = [0] * WEEKDAYS
+        for day in self.days:
+            days[weekday(day)] += 1
+        return [
+            [float(count) / days[index] if days[index] else 0.0
+             for count in counts]
+            for index, counts in enumerate(self.counts())
+        ]
+
+
+def _occupancy_python(users, slot):
+    """
+    Collects occupancy changes of users in pure Python.
+    """
+    result = Occupancy(slot)
+    changes = result.changes
+    for user in users:
+        for day, start, end in user.entries():
+            index = weekday(day)
+            result.days.add(day)
+            if end > start:
+                changes[index][start // slot] += 1
+                changes[index][(end - 1) // slot + 1] -= 1
+    return result
+
+
+def _occupancy_numpy(users, slot):
+    """
+    Collects occupancy changes of users with NumPy.
+    """
+    result = Occupancy(slot)
+    days = numpy.concatenate([column(user.days) for user in users])
+    starts = numpy.concatenate([column(user.starts) for user in users])
+    ends = numpy.concatenate([column(user.ends) for user in users])
+
+    width = result.slots() + 1
+    size = WEEKDAYS * width
+    present = ends > starts
+    base = (weekday(days) * width)[present]
+    opened = numpy.bincount(base + starts[present] // slot, minlength=size)
+    closed = numpy.bincount(base + (ends[present] - 1) // slot + 1,
+                            minlength=size)
+    result.changes = (opened - closed).reshape(WEEKDAYS, width).tolist()
+    result.days = set(numpy.unique(days).tolist())
+    return result
+
+
+def occupancy(users, slot=DEFAULT_SLOT, use_numpy=True):
+    """
+    Computes Occupancy of list of UserPresence.
+    """
+    if not users:
+        return Occupancy(slot)
+    if numpy is None or not use_numpy:
+        return _occupancy_python(users, slot)
+    return _occupancy_numpy(users, slot)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Fast parser of presence CSV files.
+"""
+
+import csv
+from datetime import date, time, datetime
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+class PresenceParser(object):
+    """
+    Parses `user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS` rows.
+
+    Fields in that layout are converted by slicing at fixed offsets, any
+    other value falls back to strptime. Parsed dates and times are interned,
+    so every row of the same day shares one date object.
+    """
+
+    def __init__(self):
+        self.dates = {}
+        self.times = {}
+        self.days = {}
+        self.seconds = {}
+
+    def parse_date(self, value):
+        """
+        Converts `YYYY-MM-DD` string to datetime.date.
+        """
+        try:
+            return self.dates[value]
+        except KeyError:
+            pass
+
+        if (len(value) == 10 and value[4] == value[7] == '-' and
+                (value[:4] + value[5:7] + value[8:]).isdigit()):
+            result = date(int(value[:4]), int(value[5:7]), int(value[8:]))
+        else:
+            result = datetime.strptime(value, '%Y-%m-%d').date()
+        self.dates[value] = result
+        return result
+
+    def parse_time(self, value):
+        """
+        Converts `HH:MM:SS` string to datetime.time.
+        """
+        try:
+            return self.times[value]
+        except KeyError:
+            pass
+
+        if (len(value) == 8 and value[2] == value[5] == ':' and
+                (value[:2] + value[3:5] + value[6:]).isdigit()):
+            result = time(int(value[:2]), int(value[3:5]), int(value[6:]))
+        else:
+            result = datetime.strptime(value, '%H:%M:%S').time()
+        self.times[value] = result
+        return result
+
+    def parse_day(self, value):
+        """
+        Converts `YYYY-MM-DD` string to proleptic Gregorian ordinal.
+        """
+        try:
+            return self.days[value]
+        except KeyError:
+            result = self.days[value] = self.parse_date(value).toordinal()
+            return result
+
+    def parse_seconds(self, value):
+        """
+        Converts `HH:MM:SS` string to amount of seconds since midnight.
+        """
+        try:
+            return self.seconds[value]
+        except KeyError:
+            parsed = self.parse_time(value)
+            result = self.seconds[value] = (
+                parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+            )
+            return result
+
+    def parse_row(self, row):
+        """
+        Converts list of four fields to (user_id, date, start, end) tuple.
+
+        Raises ValueError or TypeError for malformed rows.
+        """
+        return (
+            int(row[0]),
+            self.parse_date(row[1]),
+            self.parse_time(row[2]),
+            self.parse_time(row[3]),
+        )
+
+    def parse_record(self, row):
+        """
+        Converts list of four fields to (user_id, day, start, end) tuple of
+        integers, where day is date ordinal and start and end are seconds
+        since midnight.
+
+        Raises ValueError or TypeError for malformed rows.
+        """
+        return (
+            int(row[0]),
+            self.parse_day(row[1]),
+            self.parse_seconds(row[2]),
+            self.parse_seconds(row[3]),
+        )
+
+    def parse_lines(self, lines):
+        """
+        Yields (user_id, date, start, end) tuples for all valid lines.
+        """
+        return self._parse(lines, self.parse_row)
+
+    def parse_records(self, lines):
+        """
+        Yields (user_id, day, start, end) integer tuples for all valid lines.
+        """
+        return self._parse(lines, self.parse_record)
+
+    def _parse(self, lines, convert):
+        """
+        Yields rows converted by given function.
+
+        Lines that do not have exactly four fields (like header and footer)
+        are skipped silently, malformed ones are logged and skipped.
+        """
+        for i, line in enumerate(lines):
+            if '"' in line:
+                row = next(csv.reader([line]), [])
+            else:
+                row = line.rstrip('\r\n').split(',')
+            if len(row) != 4:
+                # ignore header and footer lines
+                continue
+
+            try:
+                parsed = convert(row)
+            except (ValueError, TypeError):
+                log.debug('Problem with line %d: ', i, exc_info=True)
+                continue
+            yield parsed
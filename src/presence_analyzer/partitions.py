@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data split into many CSV files.
+
+DATA_CSV may point to a directory of CSV files or a glob pattern matching
+them, e.g. one file per month. Manifest stored next to the files records
+date range and users of every partition, so partitions are parsed only
+when a query needs entries from their date range and unchanged partitions
+are never parsed again to build the manifest.
+"""
+import os
+import json
+import glob
+import fnmatch
+from collections import namedtuple
+
+from presence_analyzer.cache import file_signature
+from presence_analyzer.files import atomic_write
+from presence_analyzer.snapshot import SUFFIX as SNAPSHOT_SUFFIX
+from presence_analyzer.aggregates import WeekdaySummary, summarize_many
+from presence_analyzer.quantiles import WeekdayQuantiles, sketch_many
+from presence_analyzer.store import UserPresence, _finalize
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+MANIFEST_NAME = '.manifest.json'
+
+Partition = namedtuple('Partition', ['path', 'first', 'last', 'rows',
+                                     'users'])
+
+
+def _pattern(path):
+    """
+    Returns glob pattern of partition files of a directory or glob pattern,
+    or None if path is a single file.
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, '*.csv')
+    if glob.has_magic(path):
+        return path
+    return None
+
+
+def _is_partition(name):
+    """
+    Checks if file matched by pattern of partitions is not a snapshot or
+    manifest written next to them.
+    """
+    name = os.path.basename(name)
+    return not (name.endswith(SNAPSHOT_SUFFIX) or
+                name.startswith(MANIFEST_NAME))
+
+
+def partition_paths(path):
+    """
+    Returns sorted list of partition files of a directory or glob pattern,
+    or None if path is a single file.
+    """
+    pattern = _pattern(path)
+    if pattern is None:
+        return None
+    return sorted(name for name in glob.glob(pattern) if _is_partition(name))
+
+
+def dataset_signature(path):
+    """
+    Returns signature identifying current version of data file or of all
+    partition files.
+
+    First item of the signature is always the latest modification time.
+    """
+    paths = partition_paths(path)
+    if paths is None:
+        return file_signature(path)
+    partitions = tuple((name,) + file_signature(name) for name in paths)
+    return (max([mtime for __, mtime, __ in partitions] or [0]),
+            partitions)
+
+
+def manifest_path(path):
+    """
+    Returns path of manifest of partitions of a directory or glob pattern.
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, MANIFEST_NAME)
+    return os.path.join(os.path.dirname(path), MANIFEST_NAME)
+
+
+def read_manifest(path):
+    """
+    Returns {file name: entry} dict of manifest, empty if it is missing or
+    cannot be read.
+    """
+    try:
+        with open(path) as manifest:
+            return json.load(manifest)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_manifest(path, entries, removed=()):
+    """
+    Writes manifest, keeping entries of files it already lists except
+    `removed` ones.
+    """
+    manifest = read_manifest(path)
+    manifest.update(entries)
+    for key in removed:
+        manifest.pop(key, None)
+    try:
+        # hidden like the manifest, so patterns of partitions skip it
+        with atomic_write(path, MANIFEST_NAME) as tmp_path:
+            with open(tmp_path, 'w') as output:
+                json.dump(manifest, output, sort_keys=True)
+    except (IOError, OSError):
+        log.warning('Cannot write manifest %s', path, exc_info=True)
+
+
+def _bounds(partition, first, last):
+    """
+    Returns date range limits needed within a partition; None when the
+    partition is entirely in range, so its index can be used.
+    """
+    if first is not None and first <= partition.first:
+        first = None
+    if last is not None and last >= partition.last:
+        last = None
+    return first, last
+
+
+class PartitionedStore(object):
+    """
+    Presence data of all users, read from many CSV files.
+
+    Provides the same interface as PresenceStore. Partitions are loaded
+    with `loader` when their entries are needed and kept for the lifetime of
+    the store, unless they were already loaded and given in `stores` dict.
+    Entries of the same user and day in many partitions are taken from the
+    last partition, as if files were concatenated.
+    """
+
+    def __init__(self, partitions, loader, stores=None):
+        self.partitions = sorted(partitions)
+        self.loader = loader
+        self._stores = stores if stores is not None else {}
+        self.disjoint = True
+        previous = None
+        for partition in sorted(partitions, key=lambda part: part.first):
+            if previous is not None and partition.first <= previous.last:
+                self.disjoint = False
+            previous = partition
+
+    def _store(self, partition):
+        """
+        Returns store of a partition, loading it on first use.
+        """
+        store = self._stores.get(partition.path)
+        if store is None:
+            store = self._stores[partition.path] = self.loader(partition.path)
+        return store
+
+    def load_all(self):
+        """
+        Loads all partitions and returns their paths.
+        """
+        for partition in self.partitions:
+            self._store(partition)
+        return [partition.path for partition in self.partitions]
+
+    def _overlapping(self, first=None, last=None):
+        """
+        Returns partitions with entries between given day ordinals.
+        """
+        return [
+            partition for partition in self.partitions
+            if (first is None or partition.last >= first) and
+            (last is None or partition.first <= last)
+        ]
+
+    def __contains__(self, user_id):
+        return any(user_id in partition.users
+                   for partition in self.partitions)
+
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        return self.users_of([user_id])[user_id]
+
+    def __len__(self):
+        return len(self.user_ids())
+
+    def user_ids(self, first=None, last=None):
+        """
+        Returns sorted list of user ids.
+
+        When day ordinals are given, only users present between them
+        are returned; only partitions partly in range are loaded.
+        """
+        user_ids = set()
+        for partition in self._overlapping(first, last):
+            bounds = _bounds(partition, first, last)
+            if bounds == (None, None):
+                user_ids.update(partition.users)
+            else:
+                user_ids.update(self._store(partition).user_ids(*bounds))
+        return sorted(user_ids)
+
+    def known_user_ids(self, user_ids):
+        """
+        Returns given user ids which have entries, in the same order.
+        """
+        return [user_id for user_id in user_ids if user_id in self]
+
+    def users_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: UserPresence} dict of entries of given users
+        between day ordinals.
+        """
+        parts = {user_id: [] for user_id in user_ids}
+        for partition in self._overlapping(first, last):
+            present = [user_id for user_id in parts
+                       if user_id in partition.users]
+            if present:
+                bounds = _bounds(partition, first, last)
+                users = self._store(partition).users_of(present, *bounds)
+                for user_id, user in users.iteritems():
+                    parts[user_id].append(user)
+
+        result = {}
+        for user_id, users in parts.iteritems():
+            if not users:
+                result[user_id] = UserPresence()
+            elif len(users) == 1:
+                result[user_id] = users[0]
+            else:
+                merged = reduce(lambda a, b: a + b, users)
+                result[user_id] = _finalize(merged.days, merged.starts,
+                                            merged.ends)
+        return result
+
+    def _aggregate(self, name, empty, user_ids, first, last):
+        """
+        Merges per partition aggregates (summaries or quantiles) of users.
+        """
+        result = {user_id: empty() for user_id in user_ids}
+        for partition in self._overlapping(first, last):
+            present = [user_id for user_id in result
+                       if user_id in partition.users]
+            if present:
+                bounds = _bounds(partition, first, last)
+                aggregates = getattr(self._store(partition), name)(present,
+                                                                   *bounds)
+                for user_id, value in aggregates.iteritems():
+                    result[user_id] = result[user_id] + value
+        return result
+
+    def summary(self, user_id, first=None, last=None):
+        """
+        Returns WeekdaySummary of given user.
+
+        Summary is limited to entries between given day ordinals, if any.
+        """
+        return self.summaries_of([user_id], first, last)[user_id]
+
+    def summaries_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: WeekdaySummary} dict of given users.
+
+        Summaries of partitions with distinct date ranges are added up,
+        otherwise entries of partitions are merged first.
+        """
+        if not self.disjoint:
+            return summarize_many(self.users_of(user_ids, first, last))
+        return self._aggregate('summaries_of', WeekdaySummary, user_ids,
+                               first, last)
+
+    def quantiles_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: WeekdayQuantiles} dict of given users.
+        """
+        if not self.disjoint:
+            return sketch_many(self.users_of(user_ids, first, last))
+        return self._aggregate('quantiles_of', WeekdayQuantiles, user_ids,
+                               first, last)
+
+    def rows(self):
+        """
+        Returns total number of stored entries.
+        """
+        return sum(partition.rows for partition in self.partitions)
+
+    def to_dict(self):
+        """
+        Returns data in structure returned by utils.get_data().
+        """
+        return {
+            user_id: user.to_dict()
+            for user_id, user in self.users_of(self.user_ids()).iteritems()
+        }
+
+    @classmethod
+    def open(cls, path, loader):
+        """
+        Creates store of partitions of a directory or glob pattern.
+
+        Partitions missing in manifest or changed since it was written are
+        loaded to find their date ranges and users, and manifest is updated.
+        Entries of removed partitions are dropped from manifest.
+        """
+        manifest_file = manifest_path(path)
+        manifest = read_manifest(manifest_file)
+        directory = os.path.dirname(manifest_file)
+        partitions = []
+        changed = {}
+        stores = {}
+        keys = set()
+        for name in partition_paths(path):
+            key = os.path.relpath(name, directory)
+            keys.add(key)
+            mtime, size = file_signature(name)
+            entry = manifest.get(key)
+            if entry is None or [entry['mtime'], entry['size']] != [mtime,
+                                                                    size]:
+                store = stores[name] = loader(name)
+                days = [day for user_id in store.user_ids()
+                        for day in (store[user_id].days[0],
+                                    store[user_id].days[-1])]
+                entry = changed[key] = {
+                    'mtime': mtime,
+                    'size': size,
+                    'first': min(days) if days else None,
+                    'last': max(days) if days else None,
+                    'rows': store.rows(),
+                    'users': store.user_ids(),
+                }
+            if entry['rows']:
+                partitions.append(Partition(name, entry['first'],
+                                            entry['last'], entry['rows'],
+                                            frozenset(entry['users'])))
+        # manifest may be shared with other patterns of the same directory
+        pattern = _pattern(path)
+        removed = [key for key in manifest if key not in keys and
+                   fnmatch.fnmatch(os.path.join(directory, key), pattern)]
+        if changed or removed:
+            log.debug('Updating manifest %s', manifest_file)
+            write_manifest(manifest_file, changed, removed)
+
+        return cls(partitions, loader, stores)
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork server.
+
+Master process loads the dataset, with all its partitions, and forks
+worker processes serving requests from a shared listening socket, so JSON
+serialization and aggregation run on all CPUs instead of sharing one
+interpreter lock. Workers share memory pages of the dataset with the master
+copy-on-write; entries of stores are kept in arrays, whose contents are not
+touched by reference counting.
+
+Master polls data file and, when it changes, loads the new dataset, forks
+a new generation of workers and stops the old ones after they finish
+requests in progress. SIGHUP forces such reload, SIGTERM and SIGINT stop
+the server.
+"""
+import os
+import gc
+import time
+import errno
+import signal
+import socket
+
+from werkzeug.serving import BaseWSGIServer
+
+from presence_analyzer.partitions import PartitionedStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+# how often master and workers check for signals, in seconds
+POLL_INTERVAL = 1
+
+# without gc.freeze() full collections in workers are made this many times
+# rarer, as they write to every object shared with the master
+FULL_COLLECTION_FACTOR = 100
+
+
+def listen(host, port, backlog=128):
+    """
+    Returns listening socket shared by workers.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    # idle workers are all woken up by a new connection, those which lose
+    # the race for it must not block in accept()
+    listener.setblocking(0)
+    return listener
+
+
+def freeze():
+    """
+    Collects garbage before forking and moves all objects to permanent
+    generation, where available, so collections in workers do not write to
+    pages shared with the master.
+    """
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def tune_gc():
+    """
+    Makes full collections in a worker rare, where objects shared with the
+    master cannot be frozen.
+    """
+    if not hasattr(gc, 'freeze'):
+        threshold0, threshold1, threshold2 = gc.get_threshold()
+        gc.set_threshold(threshold0, threshold1,
+                         threshold2 * FULL_COLLECTION_FACTOR)
+
+
+def serve_worker(app, listener):
+    """
+    Serves requests in a worker until SIGTERM, finishing request in
+    progress.
+    """
+    stopping = []
+
+    def stop(signum, frame):  # pylint: disable-msg=W0613
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.siginterrupt(signal.SIGTERM, False)
+    # master handles these for the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    host, port = listener.getsockname()
+    server = BaseWSGIServer(host, port, app, fd=listener.fileno())
+    server.timeout = POLL_INTERVAL
+    while not stopping:
+        server.handle_request()
+    server.server_close()
+
+
+class Master(object):
+    """
+    Master process forking `workers` processes serving `app`.
+
+    Dataset of `path` in DatasetCache `cache` is loaded before forking and
+    checked for changes every `interval` seconds; with interval 0 it is
+    reloaded only on SIGHUP. All partitions of a PartitionedStore are loaded
+    too, into DatasetCache `partitions`, if given.
+    """
+
+    def __init__(self, app, cache, path, workers, interval, partitions=None):
+        self.app = app
+        self.cache = cache
+        self.path = path
+        self.workers = workers
+        self.interval = interval
+        self.partitions = partitions
+        self.entry = None
+        self.preloaded = []
+        self.listener = None
+        self.pids = set()
+        self.retired = set()
+        self._signals = []
+
+    def spawn(self):
+        """
+        Forks a worker.
+        """
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return pid
+        status = 0
+        try:
+            tune_gc()
+            # dataset is loaded already, workers never check data files
+            self.cache.watched.add(self.path)
+            if self.partitions is not None:
+                self.partitions.watched.update(self.preloaded)
+            serve_worker(self.app, self.listener)
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)  # pylint: disable-msg=W0212
+
+    def preload(self):
+        """
+        Loads all partitions of current dataset, so workers share them
+        instead of parsing them on their own.
+        """
+        store = self.entry.value
+        if isinstance(store, PartitionedStore):
+            self.preloaded = store.load_all()
+        else:
+            self.preloaded = []
+
+    def spawn_generation(self):
+        """
+        Forks workers sharing current dataset and stops previous ones.
+        """
+        self.preload()
+        freeze()
+        previous = self.pids
+        self.pids = set()
+        for i in range(self.workers):
+            self.spawn()
+        for pid in previous:
+            self.kill(pid)
+        self.retired.update(previous)
+        log.info('Started workers %s', sorted(self.pids))
+
+    def kill(self, pid, signum=signal.SIGTERM):
+        """
+        Sends signal to a worker, unless it has exited.
+        """
+        try:
+            os.kill(pid, signum)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        """
+        Collects exited workers, replacing workers of current generation.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid in self.pids:
+                log.warning('Worker %d exited with status %d, restarting',
+                            pid, status)
+                self.pids.discard(pid)
+                self.spawn()
+            self.retired.discard(pid)
+
+    def reload(self, force=False):
+        """
+        Reloads dataset if data file has changed and replaces workers.
+
+        Workers are replaced even if data is unchanged when forced. When the
+        dataset cannot be loaded current workers are kept.
+        """
+        try:
+            entry = self.cache.refresh(self.path)
+        except Exception:  # pylint: disable-msg=W0703
+            log.exception('Cannot reload dataset from %s', self.path)
+            return
+        if entry is not self.entry or force:
+            log.info('Reloading workers')
+            self.entry = entry
+            self.spawn_generation()
+
+    def _signal(self, signum, frame):  # pylint: disable-msg=W0613
+        self._signals.append(signum)
+
+    def run(self, host, port):
+        """
+        Serves requests until SIGTERM or SIGINT.
+        """
+        self.listener = listen(host, port)
+        self.entry = self.cache.get_entry(self.path)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._signal)
+        log.info('Serving on http://%s:%s with %d workers', host, port,
+                 self.workers)
+        self.spawn_generation()
+
+        checked = time.time()
+        try:
+            while True:
+                time.sleep(POLL_INTERVAL)
+                signals, self._signals[:] = self._signals[:], []
+                if signal.SIGTERM in signals or signal.SIGINT in signals:
+                    break
+                self.reap()
+                if signal.SIGHUP in signals:
+                    self.reload(force=True)
+                elif self.interval and time.time() - checked >= self.interval:
+                    self.reload()
+                else:
+                    continue
+                checked = time.time()
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Stops all workers and waits for them to finish.
+        """
+        for pid in self.pids | self.retired:
+            self.kill(pid)
+        for pid in self.pids | self.retired:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as error:
+                if error.errno != errno.ECHILD:
+                    raise
+        self.pids.clear()
+        self.retired.clear()
+        self.listener.close()
+        log.info('Server stopped')
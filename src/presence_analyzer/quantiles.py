@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Approximate percentiles of presence times.
+
+Times are counted in fixed width buckets (a minute by default), so sketches
+of any amount of entries take bounded memory, can be extended with new
+entries and merged by adding counts. Percentiles are accurate to half of
+the bucket width.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from presence_analyzer.aggregates import WEEKDAYS, column, weekday
+
+
+DAY_SECONDS = 24 * 60 * 60
+RESOLUTION = 60
+PERCENTILES = (('median', 0.5), ('p90', 0.9), ('p95', 0.95))
+
+
+class QuantileSketch(object):
+    """
+    Sparse histogram of amounts of seconds.
+    """
+    __slots__ = ('resolution', 'counts')
+
+    def __init__(self, resolution=RESOLUTION, counts=None):
+        self.resolution = resolution
+        self.counts = counts if counts is not None else {}
+
+    def __len__(self):
+        return sum(self.counts.itervalues())
+
+    def __eq__(self, other):
+        return (self.resolution == other.resolution and
+                self.counts == other.counts)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        result = QuantileSketch(self.resolution, dict(self.counts))
+        result.update(other)
+        return result
+
+    def update(self, other):
+        """
+        Merges counts of other sketch into this one.
+        """
+        if other.resolution != self.resolution:
+            raise ValueError('Cannot merge sketches of different resolution')
+        counts = self.counts
+        for bucket, count in other.counts.iteritems():
+            counts[bucket] = counts.get(bucket, 0) + count
+
+    def add(self, seconds, count=1):
+        """
+        Counts given amount of seconds.
+        """
+        bucket = seconds // self.resolution
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def quantile(self, fraction):
+        """
+        Returns value below which given fraction of counted values lies,
+        or None if nothing was counted.
+        """
+        total = len(self)
+        if not total:
+            return None
+        # nearest rank method, rank of first value is 1
+        rank = max(1, int(math.ceil(fraction * total)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                break
+        return bucket * self.resolution + self.resolution // 2
+
+
+class WeekdayQuantiles(object):
+    """
+    Per weekday sketches of start, end and length of presence.
+    """
+    __slots__ = ('starts', 'ends', 'intervals')
+
+    def __init__(self, starts=None, ends=None, intervals=None,
+                 resolution=RESOLUTION):
+        self.starts = starts or [QuantileSketch(resolution)
+                                 for i in range(WEEKDAYS)]
+        self.ends = ends or [QuantileSketch(resolution)
+                             for i in range(WEEKDAYS)]
+        self.intervals = intervals or [QuantileSketch(resolution)
+                                       for i in range(WEEKDAYS)]
+
+    def __eq__(self, other):
+        return (self.starts == other.starts and self.ends == other.ends and
+                self.intervals == other.intervals)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return WeekdayQuantiles(
+            [a + b for a, b in zip(self.starts, other.starts)],
+            [a + b for a, b in zip(self.ends, other.ends)],
+            [a + b for a, b in zip(self.intervals, other.intervals)],
+        )
+
+    def update(self, other):
+        """
+        Merges sketches of other WeekdayQuantiles into these ones.
+        """
+        for sketches, others in ((self.starts, other.starts),
+                                 (self.ends, other.ends),
+                                 (self.intervals, other.intervals)):
+            for sketch, other_sketch in zip(sketches, others):
+                sketch.update(other_sketch)
+
+    def percentiles(self, fractions=PERCENTILES):
+        """
+        Returns per weekday dicts of arrival, departure and interval
+        percentiles, given as (name, fraction) pairs.
+        """
+        result = []
+        for sketches in zip(self.starts, self.ends, self.intervals):
+            result.append({
+                name: {
+                    label: sketch.quantile(fraction)
+                    for label, fraction in fractions
+                }
+                for name, sketch in zip(('arrival', 'departure', 'interval'),
+                                        sketches)
+            })
+        return result
+
+
+def _sketch_python(user, resolution):
+    """
+    Collects sketches of single user in pure Python.
+    """
+    result = WeekdayQuantiles(resolution=resolution)
+    for day, start, end in user.entries():
+        index = weekday(day)
+        result.starts[index].add(start)
+        result.ends[index].add(end)
+        result.intervals[index].add(max(end - start, 0))
+    return result
+
+
+def _sketch_numpy(users, resolution):
+    """
+    Collects sketches of many users in one batch of NumPy operations.
+
+    Only non-empty buckets are counted, so memory used does not depend on
+    resolution.
+    """
+    lengths = [len(user) for user in users]
+    days = numpy.concatenate([column(user.days) for user in users])
+    starts = numpy.concatenate([column(user.starts) for user in users])
+    ends = numpy.concatenate([column(user.ends) for user in users])
+
+    # every (user, weekday, bucket) triple gets its own key
+    buckets = -(-DAY_SECONDS // resolution)
+    base = numpy.repeat(numpy.arange(len(users), dtype=numpy.int64) *
+                        WEEKDAYS, lengths)
+    base = (base + weekday(days)) * buckets
+
+    result = [WeekdayQuantiles(resolution=resolution) for user in users]
+    for name, values in (('starts', starts), ('ends', ends),
+                         ('intervals', numpy.maximum(ends - starts, 0))):
+        keys, counts = numpy.unique(base + values // resolution,
+                                    return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            index, bucket = divmod(key, buckets)
+            user, day = divmod(index, WEEKDAYS)
+            getattr(result[user], name)[day].counts[bucket] = count
+    return result
+
+
+def sketch_many(users, resolution=RESOLUTION, use_numpy=True):
+    """
+    Collects weekday sketches of many users.
+
+    Takes {user_id: UserPresence} dict and returns
+    {user_id: WeekdayQuantiles}.
+    """
+    user_ids = list(users)
+    if not user_ids:
+        return {}
+    if numpy is None or not use_numpy:
+        return {
+            user_id: _sketch_python(users[user_id], resolution)
+            for user_id in user_ids
+        }
+    sketches = _sketch_numpy([users[user_id] for user_id in user_ids],
+                             resolution)
+    return dict(zip(user_ids, sketches))
+
+
+def sketch(user, resolution=RESOLUTION, use_numpy=True):
+    """
+    Collects weekday sketches of single user.
+    """
+    return sketch_many({None: user}, resolution, use_numpy)[None]
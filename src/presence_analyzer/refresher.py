@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Background reloading of presence data.
+
+Refresher thread polls data file and loads its new content, so requests
+never wait for parsing; they are served from the previous dataset until
+the new one replaces it.
+"""
+import time
+import threading
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+class Refresher(threading.Thread):
+    """
+    Daemon thread refreshing dataset of a path in DatasetCache every
+    `interval` seconds.
+    """
+
+    def __init__(self, cache, path, interval):
+        super(Refresher, self).__init__(name='presence-refresher')
+        self.daemon = True
+        self.cache = cache
+        self.path = path
+        self.interval = interval
+        self.last_check = None
+        self.last_error = None
+        self._stopped = threading.Event()
+
+    def refresh(self):
+        """
+        Refreshes dataset once, logging errors.
+
+        Returns True if dataset is up to date.
+        """
+        try:
+            self.cache.refresh(self.path)
+        except Exception as error:  # pylint: disable-msg=W0703
+            log.exception('Cannot refresh dataset from %s', self.path)
+            self.last_error = '{0}: {1}'.format(type(error).__name__, error)
+            return False
+        self.last_check = time.time()
+        self.last_error = None
+        return True
+
+    def run(self):
+        self.cache.watched.add(self.path)
+        try:
+            while True:
+                self.refresh()
+                if self._stopped.wait(self.interval):
+                    break
+        finally:
+            self.cache.watched.discard(self.path)
+
+    def stop(self):
+        """
+        Stops the thread and waits for it to finish.
+        """
+        self._stopped.set()
+        self.join()
+
+    def health(self):
+        """
+        Returns dict describing state of the refresher.
+
+        Dataset is healthy when last refresh succeeded within two intervals.
+        """
+        loaded = self.cache.load_times.get(self.path)
+        return {
+            'healthy': (self.last_error is None and
+                        self.last_check is not None and
+                        time.time() - self.last_check < 2 * self.interval),
+            'last_load': loaded,
+            'last_check': self.last_check,
+            'last_error': self.last_error,
+        }
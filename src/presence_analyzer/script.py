@@ -2,10 +2,11 @@
 """Startup utilities"""
 import os
 import sys
+import time
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
+# paste, werkzeug and the application itself are imported only by entry
+# points which use them, so that e.g. `bin/flask-ctl status` starts fast
 
 etc = partial(os.path.join, 'parts', 'etc')
 
@@ -23,18 +24,28 @@ abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
 
-# bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def _configure(config=DEPLOY_CFG, debug=False):
+    """Load configuration and views of the application, without starting
+    background threads."""
     from presence_analyzer.main import app
+    from presence_analyzer import views
     app.config.from_pyfile(abspath(config))
     app.debug = debug
     return app
 
 
+# bin/paster serve parts/etc/deploy.ini
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+    from presence_analyzer.utils import start_refresher
+    app = _configure(config, debug)
+    start_refresher()
+    return app
+
+
 # bin/paster serve parts/etc/debug.ini
-def make_debug(global_conf={}, **conf):
+def make_debug(global_conf={}, config=DEBUG_CFG, **conf):
     from werkzeug.debug import DebuggedApplication
-    app = make_app(global_conf, config=DEBUG_CFG, debug=True)
+    app = make_app(global_conf, config=config, debug=True)
     return DebuggedApplication(app, evalex=True)
 
 
@@ -43,7 +54,7 @@ def make_shell():
     """Interactive Flask Shell"""
     from flask import request
     from presence_analyzer.main import init_db as initdb
-    app = make_app()
+    app = _configure()
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -57,13 +68,78 @@ def _init_db(debug=False, dry_run=False):
         return
     # Configure the application
     if debug:
-        make_debug()
+        _configure(DEBUG_CFG, debug=True)
     else:
-        make_app()
+        _configure()
     # Create the tables
     init_db()
 
 
+def _import(path='', rule='last', processes=0, debug=False, dry_run=False):
+    """Import CSV file into the configured store."""
+    from presence_analyzer.main import app, import_data
+    app.config.from_pyfile(abspath(DEBUG_CFG if debug else DEPLOY_CFG))
+    path = path or app.config['DATA_CSV']
+    print 'import_data(%r, rule=%r)' % (path, rule)
+    if dry_run:
+        return
+    started = time.time()
+    rows, duplicates, target = import_data(path, rule, processes or None)
+    elapsed = time.time() - started
+    if isinstance(target, list):
+        target = ', '.join(target)
+    print '%d rows (%d duplicates dropped) written to %s' % (
+        rows, duplicates, target)
+    print '%.1f s, %.0f rows/s' % (elapsed, (rows + duplicates) / elapsed)
+
+
+def _serve_gevent(connections=0, debug=False, dry_run=False):
+    """Serve the application with gevent."""
+    import logging.config
+    from presence_analyzer import gevent_server
+    if not gevent_server.available():
+        print 'gevent is not installed'
+        return
+    config = DEBUG_INI if debug else DEPLOY_INI
+    print 'gevent_server.serve(%s)' % config
+    if dry_run:
+        return
+    # Patch the standard library before the application creates its locks
+    gevent_server.patch()
+    logging.config.fileConfig(abspath(config))
+    from presence_analyzer.main import app
+    from presence_analyzer.utils import DATASETS, PARTITIONS
+    gevent_server.offload_loading([DATASETS, PARTITIONS])
+    wsgi_app = make_debug() if debug else make_app()
+    gevent_server.serve(
+        wsgi_app,
+        app.config['SERVER_HOST'],
+        app.config['SERVER_PORT'],
+        connections or app.config['GEVENT_CONNECTIONS'],
+    )
+
+
+def _serve_prefork(workers=0, debug=False, dry_run=False):
+    """Serve the application with pre-forked worker processes."""
+    import logging.config
+    import multiprocessing
+    from presence_analyzer.prefork import Master
+    from presence_analyzer.utils import DATASETS, PARTITIONS, get_data_path
+    config, ini = (DEBUG_CFG, DEBUG_INI) if debug else (DEPLOY_CFG, DEPLOY_INI)
+    app = _configure(config, debug)
+    workers = (workers or app.config['PREFORK_WORKERS'] or
+               multiprocessing.cpu_count())
+    print 'prefork.Master(workers=%d).run(%s:%s)' % (
+        workers, app.config['SERVER_HOST'], app.config['SERVER_PORT'])
+    if dry_run:
+        return
+    logging.config.fileConfig(abspath(ini))
+    # The master reloads data itself, no refresher thread is started
+    master = Master(app, DATASETS, get_data_path(), workers,
+                    app.config['DATA_REFRESH_INTERVAL'], PARTITIONS)
+    master.run(app.config['SERVER_HOST'], app.config['SERVER_PORT'])
+
+
 def _serve(action, debug=False, dry_run=False):
     """Build paster command from 'action' and 'debug' flag."""
     if action == 'initdb':
@@ -92,11 +168,13 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status|initdb]
@@ -127,4 +205,53 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl import [path] [--rule=last|first|longest|error]
+    def action_import(path='', rule='last', processes=0, debug=False,
+                      dry_run=False):
+        """Import CSV file into the configured store.
+
+        File (DATA_CSV by default) is parsed in chunks by a pool of
+        worker processes and written to SQLite database or snapshot of the
+        file, depending on DATA_BACKEND.
+
+        Options:
+         - 'rule' decides which entry of the same user and day is kept,
+           one of [last|first|longest|error]
+         - 'processes' number of worker processes, all CPUs by default
+         - '--debug' use debugging configuration
+         - '--dry-run' print what would be imported and exit
+        """
+        _import(path, rule, processes, debug=debug, dry_run=dry_run)
+
+    # bin/flask-ctl gevent [--connections=1000]
+    def action_gevent(connections=0, debug=False, dry_run=False):
+        """Serve the application with gevent.
+
+        Requests are handled by greenlets in the foreground, data files
+        are loaded by a pool of threads. Requires gevent.
+
+        Options:
+         - 'connections' maximum of concurrent requests, GEVENT_CONNECTIONS
+           by default
+         - '--debug' serve the debugging application
+         - '--dry-run' print the configuration and exit
+        """
+        _serve_gevent(connections, debug=debug, dry_run=dry_run)
+
+    # bin/flask-ctl prefork [--workers=4]
+    def action_prefork(workers=0, debug=False, dry_run=False):
+        """Serve the application with pre-forked worker processes.
+
+        Master process loads the data and forks workers sharing it. Data
+        file is checked every DATA_REFRESH_INTERVAL seconds and workers are
+        replaced when it changes; send SIGHUP to replace them at once.
+
+        Options:
+         - 'workers' number of worker processes, PREFORK_WORKERS or all CPUs
+           by default
+         - '--debug' use debugging configuration
+         - '--dry-run' print the configuration and exit
+        """
+        _serve_prefork(workers, debug=debug, dry_run=dry_run)
+
     werkzeug.script.run()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoding and compression of API responses.
+
+Responses are encoded with compact separators by one of ENCODERS, chosen
+with JSON_ENCODER setting, json module of the standard library by default.
+ujson, when installed, is several times faster on large responses, but it
+writes floats with 15 digits after the decimal point instead of their
+shortest representation, e.g. 31108.290000000000873 for 31108.29, which
+makes responses with many floats larger.
+"""
+import json
+import zlib
+
+try:
+    import ujson
+except ImportError:
+    ujson = None  # pylint: disable-msg=C0103
+
+
+SEPARATORS = (',', ':')
+
+COMPRESS_LEVEL = 6
+
+
+def _ujson_dumps(value):
+    """
+    Encodes value with ujson, escaping non-ASCII characters like json does.
+    """
+    return ujson.dumps(value, ensure_ascii=True, double_precision=15,
+                       escape_forward_slashes=False)
+
+
+# {name: encoding function} of available encoders
+ENCODERS = {
+    'json': json.JSONEncoder(separators=SEPARATORS).encode,
+}
+if ujson is not None:
+    ENCODERS['ujson'] = _ujson_dumps
+
+
+def get_encoder(name='json'):
+    """
+    Returns encoding function of given name.
+    """
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError('JSON encoder {0} is not available'.format(name))
+
+
+class Fragment(object):
+    """
+    Pre-encoded JSON value.
+
+    Fragment given as the first item of encoded list, e.g. its header row,
+    is inserted into output as it is. Encoders raise TypeError for
+    fragments anywhere else.
+    """
+    __slots__ = ('encoded',)
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+    def toDict(self):  # pylint: disable-msg=C0103
+        """
+        Called by ujson for objects it cannot encode.
+        """
+        raise TypeError('Fragment must be the first item of encoded list')
+
+
+def fragment(value):
+    """
+    Returns Fragment of encoded constant value.
+    """
+    return Fragment(ENCODERS['json'](value))
+
+
+def dumps(value, encoder=None):
+    """
+    Encodes value as compact JSON with given encoding function, stdlib
+    json by default.
+    """
+    encoder = encoder or ENCODERS['json']
+    if isinstance(value, list) and value and isinstance(value[0], Fragment):
+        if len(value) == 1:
+            return '[' + value[0].encoded + ']'
+        # the rest of the list is encoded at once, without its '['
+        return '[' + value[0].encoded + ',' + encoder(value[1:])[1:]
+    return encoder(value)
+
+
+def compress(body, encoding, level=COMPRESS_LEVEL):
+    """
+    Compresses body for `gzip` or `deflate` content encoding.
+    """
+    if encoding == 'gzip':
+        # window bits above 16 write gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == 'deflate':
+        return zlib.compress(body, level)
+    raise ValueError('Unknown content encoding: {0}'.format(encoding))
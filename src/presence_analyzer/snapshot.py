@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of presence store.
+
+Snapshot file layout (little-endian):
+
+    header          HEADER struct, 64 bytes
+    users           user_count * USER struct (user_id, first row, row count)
+    summaries       user_count * 21 int64 (counts, start and end totals)
+    days            row_count * int32 day ordinals
+    starts          row_count * int32 seconds since midnight
+    ends            row_count * int32 seconds since midnight
+
+Rows of every user are stored contiguously and sorted by day, so when NumPy
+is installed columns of each user are read-only views of memory mapped file
+shared by all processes reading the snapshot.
+"""
+import os
+import sys
+import mmap
+import zlib
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from presence_analyzer.aggregates import WeekdaySummary, WEEKDAYS
+from presence_analyzer.files import atomic_write
+from presence_analyzer.store import (PresenceStore, UserPresence, CsvSource,
+                                     TYPECODE, TAIL_SIZE)
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+MAGIC = 'PRESSNAP'
+VERSION = 1
+
+# suffix added to name of CSV file
+SUFFIX = '.snapshot'
+
+# magic, version, user_count, row_count, source_size, source_offset,
+# source_mtime, source_crc
+HEADER = struct.Struct('<8sIIQQQdI12x')
+USER = struct.Struct('<qqq')
+SUMMARY = struct.Struct('<%dq' % (3 * WEEKDAYS))
+COLUMN_ITEM_SIZE = 4
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def snapshot_path(csv_path):
+    """
+    Returns path of snapshot generated from given CSV file.
+    """
+    return csv_path + SUFFIX
+
+
+def checksum(path, size):
+    """
+    Calculates CRC32 of first `size` bytes of a file.
+    """
+    crc = 0
+    with open(path, 'rb') as csvfile:
+        while size > 0:
+            chunk = csvfile.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size -= len(chunk)
+    return crc & 0xffffffff
+
+
+def _column_bytes(values):
+    """
+    Returns little-endian bytes of an int32 column.
+    """
+    if not isinstance(values, array):
+        return values.tostring()
+    if sys.byteorder != 'little':  # pragma: no cover
+        values = array(TYPECODE, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def write(store, path, csv_path):
+    """
+    Writes snapshot of store loaded from csv_path.
+    """
+    source = store.source
+    stat = os.stat(csv_path)
+    user_ids = store.user_ids()
+    users = [store[user_id] for user_id in user_ids]
+    row_count = sum(len(user) for user in users)
+
+    with atomic_write(path) as tmp_path, open(tmp_path, 'wb') as output:
+        output.write(HEADER.pack(
+            MAGIC, VERSION, len(users), row_count,
+            source.size, source.offset, stat.st_mtime,
+            checksum(csv_path, source.offset),
+        ))
+        first = 0
+        for user_id, user in zip(user_ids, users):
+            output.write(USER.pack(user_id, first, len(user)))
+            first += len(user)
+        for user_id in user_ids:
+            summary = store.summary(user_id)
+            output.write(SUMMARY.pack(*(summary.counts +
+                                        summary.start_totals +
+                                        summary.end_totals)))
+        for column in ('days', 'starts', 'ends'):
+            for user in users:
+                output.write(_column_bytes(getattr(user, column)))
+
+
+def _column(mapping, offset, count):
+    """
+    Returns int32 column of `count` items stored at offset of mapping.
+    """
+    if numpy is not None:
+        return numpy.frombuffer(mapping, dtype='<i4', count=count,
+                                offset=offset)
+    values = array(TYPECODE)
+    values.fromstring(mapping[offset:offset + count * COLUMN_ITEM_SIZE])
+    if sys.byteorder != 'little':  # pragma: no cover
+        values.byteswap()
+    return values
+
+
+def _read_tail(csv_path, offset):
+    """
+    Returns bytes of CSV file preceding given offset.
+    """
+    start = max(0, offset - TAIL_SIZE)
+    with open(csv_path, 'rb') as csvfile:
+        csvfile.seek(start)
+        return csvfile.read(offset - start)
+
+
+def load(path, csv_path):
+    """
+    Loads store from snapshot of csv_path.
+
+    Returns None when snapshot does not exist, is in unknown format or
+    CSV file no longer starts with content the snapshot was created from.
+    Lines appended to CSV file since then are not included.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            mapping = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if len(mapping) < HEADER.size:
+        return None
+    (magic, version, user_count, row_count, source_size, source_offset,
+     source_mtime, source_crc) = HEADER.unpack_from(mapping)
+    if magic != MAGIC or version != VERSION:
+        log.debug('Unknown format of snapshot %s', path)
+        return None
+
+    stat = os.stat(csv_path)
+    if (stat.st_size, stat.st_mtime) != (source_size, source_mtime):
+        # unterminated last line could be rewritten without changing size
+        if (stat.st_size < source_offset or
+                stat.st_size == source_size != source_offset or
+                checksum(csv_path, source_offset) != source_crc):
+            log.debug('Snapshot %s is out of date', path)
+            return None
+
+    offset = HEADER.size
+    summaries_offset = offset + user_count * USER.size
+    days_offset = summaries_offset + user_count * SUMMARY.size
+    column_size = row_count * COLUMN_ITEM_SIZE
+    if len(mapping) != days_offset + 3 * column_size:
+        log.debug('Snapshot %s is truncated', path)
+        return None
+
+    users = {}
+    summaries = {}
+    for i in xrange(user_count):
+        user_id, first, count = USER.unpack_from(mapping, offset)
+        offset += USER.size
+        row = days_offset + first * COLUMN_ITEM_SIZE
+        users[user_id] = UserPresence(
+            _column(mapping, row, count),
+            _column(mapping, row + column_size, count),
+            _column(mapping, row + 2 * column_size, count),
+        )
+        totals = list(SUMMARY.unpack_from(mapping,
+                                          summaries_offset + i * SUMMARY.size))
+        summaries[user_id] = WeekdaySummary(totals[:WEEKDAYS],
+                                            totals[WEEKDAYS:2 * WEEKDAYS],
+                                            totals[2 * WEEKDAYS:])
+
+    store = PresenceStore(users)
+    store.summaries = summaries
+    store.source = CsvSource(stat.st_ino, source_size, source_offset,
+                             _read_tail(csv_path, source_offset))
+    return store
+
+
+def load_or_build(csv_path):
+    """
+    Loads store from snapshot of CSV file, (re)generating it when needed.
+    """
+    path = snapshot_path(csv_path)
+    store = load(path, csv_path)
+    if store is not None:
+        stat = os.stat(csv_path)
+        if stat.st_size == store.source.size:
+            return store
+        store = store.update_from_csv(csv_path)
+
+    if store is None:
+        store = PresenceStore.from_csv(csv_path)
+    try:
+        write(store, path, csv_path)
+    except (IOError, OSError):
+        log.warning('Cannot write snapshot %s', path, exc_info=True)
+    return store
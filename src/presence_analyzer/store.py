@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar in-memory storage of presence data.
+"""
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, time
+
+from presence_analyzer.parser import PresenceParser
+from presence_analyzer.aggregates import summarize_many, weekday
+from presence_analyzer.quantiles import sketch_many
+
+
+# signed 32-bit integers are enough for day ordinals and seconds
+TYPECODE = 'i'
+
+# amount of bytes before last consumed line remembered to detect rewrites
+TAIL_SIZE = 64
+
+# amount of entries converted to Python objects at once while iterating
+CHUNK_SIZE = 4096
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def _concat(first, second):
+    """
+    Concatenates two integer columns into a new array.
+
+    Columns may be arrays or read-only NumPy views of snapshot files.
+    """
+    result = array(TYPECODE)
+    for column in (first, second):
+        if isinstance(column, array):
+            result.extend(column)
+        else:
+            result.fromstring(column.tostring())
+    return result
+
+
+class UserPresence(object):
+    """
+    Presence entries of single user.
+
+    Entries are kept in three parallel arrays sorted by day: date ordinals,
+    start and end of presence as seconds since midnight.
+    """
+    __slots__ = ('days', 'starts', 'ends')
+
+    def __init__(self, days=None, starts=None, ends=None):
+        self.days = days if days is not None else array(TYPECODE)
+        self.starts = starts if starts is not None else array(TYPECODE)
+        self.ends = ends if ends is not None else array(TYPECODE)
+
+    def __len__(self):
+        return len(self.days)
+
+    def __add__(self, other):
+        """
+        Returns entries of both users, in order of operands.
+        """
+        return UserPresence(_concat(self.days, other.days),
+                            _concat(self.starts, other.starts),
+                            _concat(self.ends, other.ends))
+
+    def entries(self, first=0, last=None):
+        """
+        Yields (day, start, end) tuples of plain integers.
+
+        Optional first and last are indices limiting range of entries.
+        """
+        if last is None:
+            last = len(self.days)
+        for chunk in xrange(first, last, CHUNK_SIZE):
+            end = min(chunk + CHUNK_SIZE, last)
+            for entry in zip(self.days[chunk:end].tolist(),
+                             self.starts[chunk:end].tolist(),
+                             self.ends[chunk:end].tolist()):
+                yield entry
+
+    def day_range(self, first=None, last=None):
+        """
+        Returns (first, last) indices of entries between given day ordinals,
+        both inclusive.
+        """
+        return (
+            bisect_left(self.days, first) if first is not None else 0,
+            bisect_right(self.days, last) if last is not None
+            else len(self.days),
+        )
+
+    def __iter__(self):
+        """
+        Yields (date, start, end) tuples, start and end as seconds.
+        """
+        for day, start, end in self.entries():
+            yield date.fromordinal(day), start, end
+
+    def weekday_rows(self):
+        """
+        Yields (weekday, start, end) tuples, start and end as seconds.
+        """
+        for day, start, end in self.entries():
+            yield weekday(day), start, end
+
+    def between(self, first=None, last=None):
+        """
+        Returns entries between given day ordinals, both inclusive.
+        """
+        if first is None and last is None:
+            return self
+        first, last = self.day_range(first, last)
+        return UserPresence(self.days[first:last], self.starts[first:last],
+                            self.ends[first:last])
+
+    def to_dict(self):
+        """
+        Returns entries as {date: {'start': time, 'end': time}} dict.
+        """
+        return {
+            day: {'start': seconds_to_time(start), 'end': seconds_to_time(end)}
+            for day, start, end in self
+        }
+
+
+def _finalize(days, starts, ends):
+    """
+    Creates UserPresence from arrays in input order.
+
+    Later entries for the same day replace earlier ones.
+    """
+    ordered = all(days[i] < days[i + 1] for i in xrange(len(days) - 1))
+    if ordered:
+        return UserPresence(days, starts, ends)
+
+    entries = dict(zip(days, zip(starts, ends)))
+    user = UserPresence()
+    for day in sorted(entries):
+        start, end = entries[day]
+        user.days.append(day)
+        user.starts.append(start)
+        user.ends.append(end)
+    return user
+
+
+class CsvSource(object):
+    """
+    Describes part of CSV file already loaded into a store.
+
+    Offset points right after the last complete line, tail holds bytes
+    preceding it, so rewritten files can be told apart from appended ones.
+    """
+    __slots__ = ('inode', 'size', 'offset', 'tail')
+
+    def __init__(self, inode, size, offset, tail):
+        self.inode = inode
+        self.size = size
+        self.offset = offset
+        self.tail = tail
+
+    def is_prefix_of(self, csvfile):
+        """
+        Checks if file consists of loaded part followed by appended lines.
+        """
+        stat = os.fstat(csvfile.fileno())
+        if stat.st_ino != self.inode or stat.st_size <= self.size:
+            return False
+        csvfile.seek(self.offset - len(self.tail))
+        return csvfile.read(len(self.tail)) == self.tail
+
+
+class CsvLines(object):
+    """
+    Iterates over lines of a file counting bytes of complete lines.
+    """
+
+    def __init__(self, csvfile):
+        self.csvfile = csvfile
+        self.offset = csvfile.tell()
+
+    def __iter__(self):
+        for line in self.csvfile:
+            if line.endswith('\n'):
+                self.offset += len(line)
+            yield line
+
+    def source(self):
+        """
+        Returns CsvSource of lines consumed so far.
+        """
+        stat = os.fstat(self.csvfile.fileno())
+        start = max(0, self.offset - TAIL_SIZE)
+        self.csvfile.seek(start)
+        return CsvSource(
+            stat.st_ino,
+            stat.st_size,
+            self.offset,
+            self.csvfile.read(self.offset - start),
+        )
+
+
+def _extend_index(index, aggregate, added, extended):
+    """
+    Returns copy of index of aggregates without users in `added`, except
+    indexed `extended` users, whose aggregates are extended with their new
+    entries.
+    """
+    result = {
+        user_id: value
+        for user_id, value in index.iteritems()
+        if user_id not in added
+    }
+    indexed = {
+        user_id: user
+        for user_id, user in extended.iteritems()
+        if user_id in index
+    }
+    for user_id, value in aggregate(indexed).iteritems():
+        result[user_id] = index[user_id] + value
+    return result
+
+class PresenceStore(object):
+    """
+    Presence data of all users, indexed by user_id.
+
+    Besides raw entries store keeps index of per user weekday summaries,
+    built once when data is loaded, and of quantile sketches, built when
+    percentiles of a user are first needed.
+    """
+
+    def __init__(self, users=None):
+        self.users = users if users is not None else {}
+        self.summaries = {}
+        self.quantiles = {}
+        self.source = None
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __getitem__(self, user_id):
+        return self.users[user_id]
+
+    def __len__(self):
+        return len(self.users)
+
+    def user_ids(self, first=None, last=None):
+        """
+        Returns sorted list of user ids.
+
+        When day ordinals are given, only users present between them
+        are returned.
+        """
+        if first is None and last is None:
+            return sorted(self.users)
+        present = []
+        for user_id, user in self.users.iteritems():
+            begin, end = user.day_range(first, last)
+            if begin < end:
+                present.append(user_id)
+        return sorted(present)
+
+    def known_user_ids(self, user_ids):
+        """
+        Returns given user ids which have entries, in the same order.
+        """
+        return [user_id for user_id in user_ids if user_id in self.users]
+
+    def users_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: UserPresence} dict of entries of given users
+        between day ordinals.
+        """
+        return {
+            user_id: self.users[user_id].between(first, last)
+            for user_id in user_ids
+        }
+
+    def build_index(self):
+        """
+        Precomputes weekday summaries of all users.
+        """
+        self.summaries = summarize_many(self.users)
+
+    def summary(self, user_id, first=None, last=None):
+        """
+        Returns WeekdaySummary of given user.
+
+        Summary is limited to entries between given day ordinals, if any.
+        """
+        return self.summaries_of([user_id], first, last)[user_id]
+
+    def _aggregates_of(self, index, aggregate, user_ids, first, last,
+                       update_index=False):
+        """
+        Returns {user_id: aggregate} dict of given users, taken from index
+        when possible.
+
+        Aggregates limited to date range or missing in the index are computed
+        in one batch with `aggregate` function. With `update_index`
+        aggregates of whole history of users are added to the index.
+        """
+        indexed = first is None and last is None
+        result = {}
+        missing = {}
+        for user_id in user_ids:
+            if indexed and user_id in index:
+                result[user_id] = index[user_id]
+            else:
+                missing[user_id] = self.users[user_id].between(first, last)
+        computed = aggregate(missing)
+        if indexed and update_index:
+            index.update(computed)
+        result.update(computed)
+        return result
+
+    def summaries_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: WeekdaySummary} dict of given users.
+
+        Summaries limited to date range or missing in the index are computed
+        in one batch.
+        """
+        return self._aggregates_of(self.summaries, summarize_many, user_ids,
+                                   first, last)
+
+    def quantiles_of(self, user_ids, first=None, last=None):
+        """
+        Returns {user_id: WeekdayQuantiles} dict of given users.
+
+        Sketches limited to date range or missing in the index are computed
+        in one batch, sketches of whole history of users are added to the
+        index.
+        """
+        return self._aggregates_of(self.quantiles, sketch_many, user_ids,
+                                   first, last, update_index=True)
+
+    def rows(self):
+        """
+        Returns total number of stored entries.
+        """
+        return sum(len(user) for user in self.users.itervalues())
+
+    def records(self):
+        """
+        Yields (user_id, day, start, end) tuples of all entries.
+        """
+        for user_id in self.user_ids():
+            for day, start, end in self.users[user_id].entries():
+                yield user_id, day, start, end
+
+    def to_dict(self):
+        """
+        Returns data in structure returned by utils.get_data().
+        """
+        return {
+            user_id: user.to_dict()
+            for user_id, user in self.users.iteritems()
+        }
+
+    def appended(self, records):
+        """
+        Returns new store extended with (user_id, day, start, end) tuples.
+
+        Store itself is left untouched, as other threads may be reading it.
+        Users without new entries are shared by both stores, summaries and
+        already built sketches of users whose entries were only appended are
+        updated incrementally.
+        """
+        added = self.from_records(records, index=False).users
+        users = dict(self.users)
+        extended = {}
+        for user_id, new in added.iteritems():
+            old = self.users.get(user_id)
+            if old is None:
+                users[user_id] = new
+            elif old.days[-1] < new.days[0]:
+                users[user_id] = old + new
+                extended[user_id] = new
+            else:
+                # some days were overwritten, entries have to be merged
+                merged = old + new
+                users[user_id] = _finalize(merged.days, merged.starts,
+                                           merged.ends)
+
+        store = self.__class__(users)
+        store.summaries = _extend_index(self.summaries, summarize_many,
+                                        added, extended)
+        store.summaries.update(summarize_many({
+            user_id: users[user_id]
+            for user_id in added
+            if user_id not in store.summaries
+        }))
+        store.quantiles = _extend_index(self.quantiles, sketch_many, added,
+                                        extended)
+        return store
+
+    @classmethod
+    def from_records(cls, records, index=True):
+        """
+        Creates store from (user_id, day, start, end) integer tuples.
+        """
+        columns = {}
+        for user_id, day, start, end in records:
+            try:
+                days, starts, ends = columns[user_id]
+            except KeyError:
+                days, starts, ends = columns[user_id] = (
+                    array(TYPECODE), array(TYPECODE), array(TYPECODE)
+                )
+            days.append(day)
+            starts.append(start)
+            ends.append(end)
+
+        store = cls({
+            user_id: _finalize(*user_columns)
+            for user_id, user_columns in columns.iteritems()
+        })
+        if index:
+            store.build_index()
+        return store
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Creates store from presence CSV file.
+        """
+        with open(path, 'rb') as csvfile:
+            lines = CsvLines(csvfile)
+            store = cls.from_records(PresenceParser().parse_records(lines))
+            store.source = lines.source()
+        return store
+
+    def update_from_csv(self, path):
+        """
+        Returns store extended with lines appended to CSV file since it was
+        loaded, or None if the file was truncated or replaced.
+        """
+        if self.source is None:
+            return None
+
+        with open(path, 'rb') as csvfile:
+            if not self.source.is_prefix_of(csvfile):
+                return None
+            csvfile.seek(self.source.offset)
+            lines = CsvLines(csvfile)
+            store = self.appended(PresenceParser().parse_records(lines))
+            store.source = lines.source()
+        return store
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Team and organization wide statistics.
+
+Distribution of presence time is computed from users' precomputed summaries,
+headcount from their entries clipped to the date range, both in-process.
+"""
+from presence_analyzer.aggregates import WEEKDAYS
+from presence_analyzer.occupancy import occupancy
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+HOUR = 60 * 60
+PERCENTILES = (('p25', 0.25), ('median', 0.5), ('p75', 0.75), ('p90', 0.9))
+
+
+def percentile(values, fraction):
+    """
+    Returns percentile of sorted values with linear interpolation.
+    """
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def team_statistics(summaries, users):
+    """
+    Computes weekday statistics of group of users.
+
+    Takes Summary of every user and their UserPresence limited to the same
+    date range. Distribution (mean, median and percentiles) of users' mean
+    presence time and mean headcount per hour are returned for every
+    weekday.
+    """
+    means = [[] for i in range(WEEKDAYS)]
+    for summary in summaries:
+        mean_intervals = summary.mean_intervals()
+        for weekday, count in enumerate(summary.counts):
+            if count:
+                means[weekday].append(mean_intervals[weekday])
+    headcount = occupancy(list(users), HOUR)
+
+    presence = []
+    for weekday in range(WEEKDAYS):
+        values = sorted(means[weekday])
+        distribution = {
+            'users': len(values),
+            'mean': float(sum(values)) / len(values) if values else 0.0,
+        }
+        for name, fraction in PERCENTILES:
+            distribution[name] = percentile(values, fraction)
+        presence.append(distribution)
+    return presence, headcount.means()
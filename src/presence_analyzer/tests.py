@@ -2,12 +2,24 @@
 """
 Presence analyzer unit tests.
 """
+import os
 import os.path
 import json
+import shutil
 import datetime
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
-from presence_analyzer import main, views, utils
+from werkzeug.http import http_date
+
+from presence_analyzer import (main, views, utils, cache, parser, store,
+                              aggregates, snapshot, team, occupancy,
+                              quantiles, instrumentation, refresher,
+                              database, importer, partitions, prefork,
+                              serializers, gevent_server)
 
 
 TEST_DATA_CSV = os.path.join(
@@ -63,6 +75,9 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         resp = self.client.get('/mean_time_weekday.html')
         self.assertEqual(resp.status_code, 200)
 
+        resp = self.client.get('/occupancy.html')
+        self.assertEqual(resp.status_code, 200)
+
     def test_mainpage_error(self):
         """
         Test raises error when page or resource not found
@@ -161,6 +176,328 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data[0], [u'Mon', 0, 0])
 
+    def test_api_conditional_request(self):
+        """
+        Test unchanged data is not sent again.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertNotIn('Last-Modified', resp.headers)
+        self.assertIn('max-age=0', resp.headers['Cache-Control'])
+
+        resp = self.client.get('/api/v1/presence_weekday/11',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_api_conditional_request_invalid(self):
+        """
+        Test invalid requests are rejected even if conditional.
+        """
+        resp = self.client.get('/api/v1/users')
+        for headers in ({'If-None-Match': '*'},
+                        {'If-None-Match': resp.headers['ETag']}):
+            for url in ('/api/v1/mean_time_weekday/',
+                        '/api/v1/presence_weekday/',
+                        '/api/v1/presence_start_end/',
+                        '/api/v1/users?from=2013-09'):
+                resp = self.client.get(url, headers=headers)
+                self.assertEqual(resp.status_code, 400)
+            resp = self.client.get('/api/v1/users', headers=headers)
+            self.assertEqual(resp.status_code, 304)
+
+    def test_api_compressed(self):
+        """
+        Test large responses are compressed for clients accepting it.
+        """
+        self.addCleanup(main.app.config.update,
+                        {'RESPONSE_COMPRESS_MIN_SIZE': None})
+        main.app.config.update({'RESPONSE_COMPRESS_MIN_SIZE': 50})
+        plain = self.client.get('/api/v1/users')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        headers = {'Accept-Encoding': 'deflate;q=0.5, gzip'}
+        resp = self.client.get('/api/v1/users', headers=headers)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+        self.assertEqual(zlib.decompress(resp.data, 16 + zlib.MAX_WBITS),
+                         plain.data)
+
+        # small responses are sent as they are, with the same ETag
+        resp = self.client.get('/api/v1/presence_start_end/987',
+                               headers=headers)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, '[]')
+        self.assertEqual(
+            resp.headers['ETag'],
+            self.client.get('/api/v1/presence_start_end/987').headers['ETag']
+        )
+
+    def test_api_conditional_request_modified(self):
+        """
+        Test ETag changes together with data.
+        """
+        resp = self.client.get('/api/v1/users')
+        headers = {'If-None-Match': resp.headers['ETag']}
+        resp = self.client.get('/api/v1/users', headers=headers)
+        self.assertEqual(resp.status_code, 304)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'data.csv')
+            shutil.copy(TEST_DATA_CSV, path)
+            main.app.config.update({'DATA_CSV': path})
+            resp = self.client.get('/api/v1/users', headers=headers)
+            self.assertEqual(resp.status_code, 200)
+
+            # data changed with modification time moved backwards
+            headers = {'If-None-Match': resp.headers['ETag'],
+                       'If-Modified-Since': http_date(time.time())}
+            stat = os.stat(path)
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            os.utime(path, (stat.st_atime, stat.st_mtime - 60))
+            resp = self.client.get('/api/v1/users', headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('"user_id":12', resp.data)
+            del headers['If-None-Match']
+            resp = self.client.get('/api/v1/users', headers=headers)
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_api_batch(self):
+        """
+        Test statistics of many users in one response.
+        """
+        resp = self.client.get('/api/v1/batch?user_id=10,987&user_id=11'
+                               '&metric=mean_time&metric=presence')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual([entry['user_id'] for entry in data], [10, 987, 11])
+        self.assertItemsEqual(data[0].keys(),
+                              ['user_id', 'mean_time', 'presence'])
+        single = self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(data[2]['presence'], json.loads(single.data))
+        self.assertEqual(data[1]['mean_time'], [])
+
+    def test_api_batch_all(self):
+        """
+        Test batch of all users with all metrics.
+        """
+        resp = self.client.get('/api/v1/batch?user_id=all')
+        data = json.loads(resp.data)
+        self.assertEqual([entry['user_id'] for entry in data], [10, 11])
+        single = self.client.get('/api/v1/presence_start_end/10')
+        self.assertEqual(data[0]['start_end'], json.loads(single.data))
+
+    def test_api_batch_bad_request(self):
+        """
+        Test batch parameters validation.
+        """
+        for query in ('', '?user_id=x', '?user_id=10&metric=unknown'):
+            resp = self.client.get('/api/v1/batch' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_export_csv(self):
+        """
+        Test CSV export can be parsed back.
+        """
+        resp = self.client.get('/api/v1/export.csv')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        exported = store.PresenceStore.from_records(
+            parser.PresenceParser().parse_records(resp.data.splitlines())
+        )
+        self.assertEqual(exported.to_dict(),
+                         store.PresenceStore.from_csv(TEST_DATA_CSV).to_dict())
+
+    def test_api_export_ndjson(self):
+        """
+        Test NDJSON export filtered by user and dates.
+        """
+        resp = self.client.get('/api/v1/export.ndjson?user_id=10'
+                               '&from=2013-09-11&to=2013-09-12')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(lines, [
+            {'user_id': 10, 'date': '2013-09-11',
+             'start': '09:19:52', 'end': '16:07:37'},
+            {'user_id': 10, 'date': '2013-09-12',
+             'start': '10:48:46', 'end': '17:23:51'},
+        ])
+
+    def test_api_export_errors(self):
+        """
+        Test export of unknown format and with invalid dates.
+        """
+        resp = self.client.get('/api/v1/export.xml')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/export.csv?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_date_range(self):
+        """
+        Test statistics limited with from and to parameters.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10'
+                               '?from=2013-09-11&to=2013-09-11')
+        data = json.loads(resp.data)
+        self.assertEqual(data[3], [u'Wed', 24465])
+        self.assertEqual(sum(value for day, value in data[1:]), 24465)
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-09-12')
+        data = json.loads(resp.data)
+        self.assertEqual(data[3], [u'Thu', 23705.0])
+        self.assertEqual(data[1], [u'Tue', 0.0])
+
+        resp = self.client.get('/api/v1/users?to=2013-09-09')
+        self.assertEqual(json.loads(resp.data),
+                         [{u'user_id': 11, u'name': u'User 11'}])
+
+        resp = self.client.get('/api/v1/presence_start_end/10?to=2013-09')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_team_weekday(self):
+        """
+        Test team statistics view.
+        """
+        resp = self.client.get('/api/v1/team_weekday')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['presence']), 7)
+        self.assertEqual(data['presence'][1]['weekday'], u'Tue')
+        self.assertEqual(data['presence'][1]['users'], 2)
+        self.assertEqual(data['headcount'][1][0], u'Tue')
+        self.assertEqual(len(data['headcount'][1][1]), 24)
+
+        resp = self.client.get('/api/v1/team_weekday?user_id=10')
+        data = json.loads(resp.data)
+        self.assertEqual(data['presence'][1]['users'], 1)
+
+        resp = self.client.get('/api/v1/team_weekday?from=2013-09-11')
+        data = json.loads(resp.data)
+        self.assertEqual(data['presence'][1]['users'], 0)
+        self.assertEqual(data['headcount'][1][1][9], 0.0)
+
+    def test_api_occupancy(self):
+        """
+        Test occupancy view.
+        """
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['slots']), 96)
+        self.assertEqual(data['slots'][38], u'09:30')
+        self.assertEqual(data['occupancy'][1][0], u'Tue')
+        self.assertEqual(data['occupancy'][1][1][37], 1.0)
+        self.assertEqual(data['occupancy'][1][1][38], 2.0)
+
+        resp = self.client.get('/api/v1/occupancy?slot=60&user_id=10')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['slots']), 24)
+        self.assertEqual(data['occupancy'][1][1][9], 1.0)
+
+        for slot in ('7', '0', 'x'):
+            resp = self.client.get('/api/v1/occupancy?slot=' + slot)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_presence_percentiles(self):
+        """
+        Test presence percentiles view.
+        """
+        resp = self.client.get('/api/v1/presence_percentiles?user_id=11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[0], [u'Mon', {
+            u'arrival': {u'median': 33150, u'p90': 33150, u'p95': 33150},
+            u'departure': {u'median': 57270, u'p90': 57270, u'p95': 57270},
+            u'interval': {u'median': 24150, u'p90': 24150, u'p95': 24150},
+        }])
+        self.assertIsNone(data[5][1]['arrival']['median'])
+
+        resp = self.client.get('/api/v1/presence_percentiles')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1][1]['arrival'],
+                         {u'median': 33570, u'p90': 34770, u'p95': 34770})
+
+    def test_api_server_timing(self):
+        """
+        Test request phases are reported in Server-Timing header.
+        """
+        utils.get_response_cache().clear()
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        phases = [timing.split(';')[0]
+                  for timing in resp.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['load', 'aggregate', 'serialize', 'total'])
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertTrue(resp.headers['Server-Timing'].startswith('load;'))
+
+    def test_metrics(self):
+        """
+        Test metrics endpoint.
+        """
+        instrumentation.REQUEST_TIMES.clear()
+        utils.get_response_cache().clear()
+        self.client.get('/api/v1/users')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(
+            resp.content_type.startswith('text/plain; version=0.0.4')
+        )
+        lines = resp.data.splitlines()
+        self.assertIn('# TYPE presence_analyzer_request_duration_seconds '
+                      'histogram', lines)
+        self.assertIn('presence_analyzer_request_duration_seconds_count'
+                      '{endpoint="users_view",phase="total"} 1', lines)
+        self.assertIn('presence_analyzer_response_cache_misses_total 1',
+                      lines)
+
+    def test_profile(self):
+        """
+        Test profiles of requests are dumped on demand.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        main.app.config.update(PROFILE_DIR=directory)
+        self.addCleanup(main.app.config.update, PROFILE_DIR=None)
+
+        self.client.get('/api/v1/users')
+        self.assertEqual(os.listdir(directory), [])
+        self.client.get('/api/v1/users?profile')
+        profiles = os.listdir(directory)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('users_view-'))
+
+    def test_health(self):
+        """
+        Test health endpoint.
+        """
+        resp = self.client.get('/health')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertTrue(data['healthy'])
+        self.assertFalse(data['refresher'])
+        self.assertIsNotNone(data['last_load'])
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV + '.missing'})
+        resp = self.client.get('/health')
+        self.assertEqual(resp.status_code, 503)
+        data = json.loads(resp.data)
+        self.assertFalse(data['healthy'])
+        self.assertIsNone(data['last_load'])
+
     def test_api_bad_request(self):
         """
         Test error
@@ -290,6 +627,1332 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(result[6], [0, 0])
 
 
+class PresenceAnalyzerParserTestCase(unittest.TestCase):
+    """
+    CSV parser tests.
+    """
+
+    def test_parse_lines(self):
+        """
+        Test parsing of valid, malformed and header lines.
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '11,2013-9-10,9:05:00,17:00:00\n',
+            '"12",2013-09-10,09:39:05,17:59:52\n',
+            '13,2013-02-30,09:39:05,17:59:52\n',
+            '14,2013-09-10,25:00:00,17:59:52\n',
+            'x,2013-09-10,09:39:05,17:59:52\n',
+            '\n',
+        ]
+        result = list(parser.PresenceParser().parse_lines(lines))
+        self.assertEqual(result, [
+            (10, datetime.date(2013, 9, 10),
+             datetime.time(9, 39, 5), datetime.time(17, 59, 52)),
+            (11, datetime.date(2013, 9, 10),
+             datetime.time(9, 5, 0), datetime.time(17, 0, 0)),
+            (12, datetime.date(2013, 9, 10),
+             datetime.time(9, 39, 5), datetime.time(17, 59, 52)),
+        ])
+
+    def test_parse_interning(self):
+        """
+        Test same dates are represented by the same object.
+        """
+        lines = [
+            '10,2013-09-10,09:39:05,17:59:52',
+            '11,2013-09-10,09:39:05,17:59:52',
+        ]
+        first, second = parser.PresenceParser().parse_lines(lines)
+        self.assertIs(first[1], second[1])
+        self.assertIs(first[2], second[2])
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar store tests.
+    """
+
+    def test_from_csv(self):
+        """
+        Test building store from CSV file.
+        """
+        data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        self.assertEqual(data.user_ids(), [10, 11])
+        self.assertEqual(data.rows(), 9)
+        self.assertIn(10, data)
+        self.assertNotIn(12, data)
+        self.assertEqual(list(data[10])[0],
+                         (datetime.date(2013, 9, 10), 34745, 64792))
+
+    def test_from_records_unordered(self):
+        """
+        Test entries are sorted by day and duplicates replaced.
+        """
+        data = store.PresenceStore.from_records([
+            (10, 735000, 100, 200),
+            (10, 734000, 300, 400),
+            (10, 735000, 500, 600),
+        ])
+        self.assertEqual(list(data[10].days), [734000, 735000])
+        self.assertEqual(list(data[10].starts), [300, 500])
+        self.assertEqual(list(data[10].ends), [400, 600])
+
+    def test_between(self):
+        """
+        Test selecting entries from date range.
+        """
+        data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        first = datetime.date(2013, 9, 11).toordinal()
+        last = datetime.date(2013, 9, 12).toordinal()
+        self.assertEqual(data[10].day_range(first, last), (1, 3))
+        self.assertEqual(data[10].day_range(), (0, 3))
+        self.assertEqual(list(data[10].between(first).days),
+                         list(data[10].days[1:]))
+        self.assertEqual(len(data[10].between(last=first - 1)), 1)
+        self.assertEqual(data.user_ids(first, last), [10, 11])
+        self.assertEqual(data.user_ids(last + 1), [11])
+        self.assertEqual(data.summary(10, first, last).counts,
+                         [0, 0, 1, 1, 0, 0, 0])
+
+    def test_summary_index(self):
+        """
+        Test weekday summaries are precomputed on load.
+        """
+        data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        self.assertItemsEqual(data.summaries.keys(), [10, 11])
+        self.assertEqual(data.summary(11), aggregates.summarize(data[11]))
+        self.assertEqual(data.summary(11).counts, [1, 1, 1, 2, 1, 0, 0])
+
+    def test_to_dict(self):
+        """
+        Test conversion to nested dicts.
+        """
+        data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        self.assertEqual(
+            data.to_dict()[10][datetime.date(2013, 9, 10)],
+            {'start': datetime.time(9, 39, 5),
+             'end': datetime.time(17, 59, 52)}
+        )
+
+    def test_group_by_weekday_store(self):
+        """
+        Test grouping accepts columnar entries.
+        """
+        data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        from_store = utils.group_by_weekday(data[11])
+        from_dict = utils.group_by_weekday(data.to_dict()[11])
+        for weekday in range(7):
+            self.assertItemsEqual(from_store[weekday], from_dict[weekday])
+
+
+class PresenceAnalyzerAggregatesTestCase(unittest.TestCase):
+    """
+    Weekday aggregation tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+
+    def test_summarize(self):
+        """
+        Test aggregates match grouping helpers.
+        """
+        for use_numpy in (True, False):
+            summary = aggregates.summarize(self.data[10], use_numpy)
+            grouped = utils.group_by_weekday(self.data[10])
+            self.assertEqual(summary.counts,
+                             [len(grouped[i]) for i in range(7)])
+            self.assertEqual(summary.totals(),
+                             [sum(grouped[i]) for i in range(7)])
+            self.assertEqual(summary.mean_intervals(),
+                             [utils.mean(grouped[i]) for i in range(7)])
+            start_end = utils.group_by_weekday_start_end(self.data[10])
+            self.assertEqual(summary.mean_starts(),
+                             [start_end[i][0] for i in range(7)])
+            self.assertEqual(summary.mean_ends(),
+                             [start_end[i][1] for i in range(7)])
+
+    def test_summarize_many(self):
+        """
+        Test batched aggregation matches per user one.
+        """
+        many = aggregates.summarize_many(self.data.users)
+        python = aggregates.summarize_many(self.data.users, use_numpy=False)
+        self.assertEqual(sorted(many), [10, 11])
+        for user_id in many:
+            self.assertEqual(many[user_id], python[user_id])
+            self.assertEqual(many[user_id],
+                             aggregates.summarize(self.data[user_id]))
+        self.assertEqual(aggregates.summarize_many({}), {})
+
+
+class PresenceAnalyzerTeamTestCase(unittest.TestCase):
+    """
+    Team statistics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        self.users = [self.data[user_id] for user_id in self.data.user_ids()]
+
+    def test_percentile(self):
+        """
+        Test percentiles with linear interpolation.
+        """
+        self.assertEqual(team.percentile([], 0.5), 0.0)
+        self.assertEqual(team.percentile([1, 2, 3, 4], 0.5), 2.5)
+        self.assertEqual(team.percentile([1, 2, 3, 4], 0.0), 1)
+        self.assertEqual(team.percentile([1, 2, 3, 4], 1.0), 4)
+
+    def test_team_statistics(self):
+        """
+        Test distribution and headcount of users.
+        """
+        presence, headcount = team.team_statistics(
+            self.data.summaries_of(self.data.user_ids()).values(),
+            self.users,
+        )
+        # Tuesday 2013-09-10: user 10 09:39-17:59, user 11 09:19-13:55
+        self.assertEqual(presence[1]['users'], 2)
+        self.assertEqual(presence[1]['median'], (30047 + 16564) / 2.0)
+        self.assertEqual(headcount[1][8], 0.0)
+        self.assertEqual(headcount[1][9], 2.0)
+        self.assertEqual(headcount[1][14], 1.0)
+        self.assertEqual(headcount[1][18], 0.0)
+        self.assertEqual(presence[6]['users'], 0)
+
+    def test_team_statistics_empty(self):
+        """
+        Test statistics of no users.
+        """
+        presence, headcount = team.team_statistics([], [])
+        self.assertEqual(presence[1]['users'], 0)
+        self.assertEqual(presence[1]['median'], 0.0)
+        self.assertEqual(headcount[1][9], 0.0)
+
+
+class PresenceAnalyzerOccupancyTestCase(unittest.TestCase):
+    """
+    Occupancy engine tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        self.users = [self.data[user_id] for user_id in self.data.user_ids()]
+
+    def test_occupancy(self):
+        """
+        Test counting people present in slots.
+        """
+        for use_numpy in (True, False):
+            result = occupancy.occupancy(self.users, 3600, use_numpy)
+            self.assertEqual(result.slots(), 24)
+            counts = result.counts()
+            self.assertEqual(counts[1][8:19],
+                             [0, 2, 2, 2, 2, 2, 1, 1, 1, 1, 0])
+            self.assertEqual(result.means()[3][10], 1.5)
+            self.assertEqual(len(result.days), 6)
+
+    def test_occupancy_merge(self):
+        """
+        Test occupancy of user groups can be merged.
+        """
+        merged = (occupancy.occupancy(self.users[:1]) +
+                  occupancy.occupancy(self.users[1:]))
+        self.assertEqual(merged, occupancy.occupancy(self.users))
+        self.assertEqual(occupancy.occupancy([]).counts()[0], [0] * 96)
+        self.assertRaises(ValueError, occupancy.Occupancy, 7 * 60)
+
+
+class PresenceAnalyzerQuantilesTestCase(unittest.TestCase):
+    """
+    Quantile sketches tests.
+    """
+
+    def test_quantile(self):
+        """
+        Test percentiles of a sketch.
+        """
+        sketch = quantiles.QuantileSketch(1)
+        self.assertIsNone(sketch.quantile(0.5))
+        for seconds in range(1, 101):
+            sketch.add(seconds)
+        self.assertEqual(len(sketch), 100)
+        self.assertEqual(sketch.quantile(0.5), 50)
+        self.assertEqual(sketch.quantile(0.9), 90)
+        self.assertEqual(sketch.quantile(0), 1)
+        self.assertEqual(sketch.quantile(1), 100)
+
+        sketch = quantiles.QuantileSketch(60)
+        sketch.add(125)
+        self.assertEqual(sketch.quantile(0.5), 150)
+
+    def test_merge(self):
+        """
+        Test sketches of parts of data can be merged.
+        """
+        first = quantiles.QuantileSketch(1, {1: 2})
+        second = quantiles.QuantileSketch(1, {1: 1, 3: 3})
+        self.assertEqual((first + second).counts, {1: 3, 3: 3})
+        self.assertEqual(first.counts, {1: 2})
+        self.assertRaises(ValueError, first.__add__,
+                          quantiles.QuantileSketch(60))
+
+        data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        user = data[11]
+        self.assertEqual(quantiles.sketch(user.between(None, 735118)) +
+                         quantiles.sketch(user.between(735119, None)),
+                         quantiles.sketch(user))
+
+        merged = quantiles.WeekdayQuantiles()
+        parts = [quantiles.sketch(user.between(None, 735118)),
+                 quantiles.sketch(user.between(735119, None))]
+        for part in parts:
+            merged.update(part)
+        self.assertEqual(merged, quantiles.sketch(user))
+        self.assertEqual(parts[0], quantiles.sketch(user.between(None,
+                                                                 735118)))
+
+    def test_sketch(self):
+        """
+        Test NumPy and pure Python sketches are equal.
+        """
+        data = store.PresenceStore.from_csv(TEST_DATA_CSV)
+        self.assertEqual(quantiles.sketch_many(data.users),
+                         quantiles.sketch_many(data.users, use_numpy=False))
+        self.assertEqual(quantiles.sketch_many(data.users, 1),
+                         quantiles.sketch_many(data.users, 1, False))
+        # sketches are built on first use
+        self.assertEqual(data.quantiles, {})
+        data.quantiles_of([10])
+        self.assertEqual(sorted(data.quantiles), [10])
+        self.assertEqual(data.quantiles[10].starts[1].counts, {579: 1})
+        self.assertEqual(data.quantiles[10].intervals[1].counts, {500: 1})
+        data.quantiles_of([11], 735119)
+        self.assertEqual(sorted(data.quantiles), [10])
+
+
+class PresenceAnalyzerInstrumentationTestCase(unittest.TestCase):
+    """
+    Instrumentation tests.
+    """
+
+    def test_histograms(self):
+        """
+        Test rendering histograms in Prometheus text format.
+        """
+        histograms = instrumentation.Histograms(('endpoint',))
+        histograms.observe(('a"b',), 0.003)
+        histograms.observe(('a"b',), 0.003)
+        histograms.observe(('a"b',), 20)
+        lines = histograms.render('test', 'Test.')
+        self.assertEqual(lines[:2], ['# HELP test Test.',
+                                     '# TYPE test histogram'])
+        self.assertEqual(lines[2], 'test_bucket{endpoint="a\\"b",'
+                                   'le="0.001"} 0')
+        self.assertIn('test_bucket{endpoint="a\\"b",le="0.005"} 2', lines)
+        self.assertIn('test_bucket{endpoint="a\\"b",le="10.0"} 2', lines)
+        self.assertIn('test_bucket{endpoint="a\\"b",le="+Inf"} 3', lines)
+        self.assertEqual(lines[-1], 'test_count{endpoint="a\\"b"} 3')
+
+
+class PresenceAnalyzerSerializersTestCase(unittest.TestCase):
+    """
+    JSON encoding and compression tests.
+    """
+
+    def test_encoders(self):
+        """
+        Test available encoders give the same compact JSON.
+        """
+        value = [('Mon', 32456.5, 0.25), {'a': [1, None]}, u'\u017c/x']
+        expected = '[["Mon",32456.5,0.25],{"a":[1,null]},"\\u017c/x"]'
+        self.assertEqual(serializers.get_encoder('json')(value), expected)
+        self.assertIs(serializers.get_encoder(), serializers.ENCODERS['json'])
+        for name, encoder in serializers.ENCODERS.iteritems():
+            self.assertEqual(json.loads(encoder(value)), json.loads(expected))
+        with self.assertRaises(ValueError):
+            serializers.get_encoder('missing')
+
+    def test_dumps_fragment(self):
+        """
+        Test pre-encoded fragments are inserted as they are.
+        """
+        header = serializers.fragment(('Weekday', 'Presence (s)'))
+        self.assertEqual(serializers.dumps([header, ('Mon', 1)]),
+                         '[["Weekday","Presence (s)"],["Mon",1]]')
+        self.assertEqual(serializers.dumps([header]),
+                         '[["Weekday","Presence (s)"]]')
+        self.assertEqual(serializers.dumps([]), '[]')
+        for encoder in serializers.ENCODERS.values():
+            for value in ([1, header], [[header]], {'header': header}):
+                self.assertRaises(TypeError, serializers.dumps, value,
+                                  encoder)
+
+    def test_compress(self):
+        """
+        Test gzip and deflate compression.
+        """
+        body = '[1,2,3]' * 100
+        gzipped = serializers.compress(body, 'gzip')
+        self.assertEqual(zlib.decompress(gzipped, 16 + zlib.MAX_WBITS), body)
+        self.assertEqual(zlib.decompress(serializers.compress(body,
+                                                              'deflate')),
+                         body)
+        with self.assertRaises(ValueError):
+            serializers.compress(body, 'br')
+
+
+class PresenceAnalyzerDatabaseTestCase(unittest.TestCase):
+    """
+    SQLite storage tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'presence.db')
+        database.build_database(TEST_DATA_CSV, self.path)
+        self.data = database.SqliteStore(self.path)
+        self.expected = store.PresenceStore.from_csv(TEST_DATA_CSV)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_users(self):
+        """
+        Test reading entries of users.
+        """
+        self.assertEqual(len(self.data), 2)
+        self.assertEqual(self.data.rows(), 9)
+        self.assertIn(10, self.data)
+        self.assertNotIn(12, self.data)
+        self.assertRaises(KeyError, self.data.__getitem__, 12)
+        self.assertEqual(self.data.user_ids(), [10, 11])
+        self.assertEqual(self.data.user_ids(735122, None), [10, 11])
+        self.assertEqual(self.data.user_ids(None, 735118), [11])
+        self.assertEqual(self.data.to_dict(), self.expected.to_dict())
+        self.assertEqual(list(self.data[11]), list(self.expected[11]))
+        users = self.data.users_of([10, 11, 12], 735122, 735122)
+        self.assertEqual(len(users[10]), 1)
+        self.assertEqual(len(users[12]), 0)
+        for data in (self.data, self.expected):
+            self.assertEqual(data.known_user_ids([12, 11, 10]), [11, 10])
+
+    def test_summaries(self):
+        """
+        Test weekday aggregation done by SQLite.
+        """
+        self.assertEqual(self.data.summary(10), self.expected.summary(10))
+        self.assertEqual(self.data.summaries_of([10, 11], 735119, 735122),
+                         self.expected.summaries_of([10, 11], 735119, 735122))
+        self.assertEqual(self.data.quantiles_of([10, 11]),
+                         self.expected.quantiles_of([10, 11]))
+
+    def test_build_database_replaces(self):
+        """
+        Test later entries of the same day replace earlier ones.
+        """
+        path = os.path.join(self.tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n'
+                          '10,2013-09-10,10:00:00,16:00:00\n')
+        database.build_database(path, self.path)
+        data = database.SqliteStore(self.path)
+        self.assertEqual(list(data[10]),
+                         [(datetime.date(2013, 9, 10), 36000, 57600)])
+
+    def test_write_database_failed(self):
+        """
+        Test failed write keeps the old database and no temporary files.
+        """
+        def records():
+            yield 10, 735121, 32400, 61200
+            raise ValueError('broken record')
+
+        with self.assertRaises(ValueError):
+            database.write_database(records(), self.path)
+        self.assertEqual(os.listdir(self.tmpdir), ['presence.db'])
+        self.assertEqual(database.SqliteStore(self.path).rows(), 9)
+
+    def test_views(self):
+        """
+        Test views served from SQLite backend.
+        """
+        main.app.config.update(DATA_BACKEND='sqlite', DATA_DB=self.path,
+                               DATA_CSV=TEST_DATA_CSV)
+        self.addCleanup(main.app.config.update, DATA_BACKEND='csv')
+        client = main.app.test_client()
+        resp = client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(json.loads(resp.data)[1], [u'Tue', 30047.0])
+        resp = client.get('/api/v1/users')
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_init_db(self):
+        """
+        Test init_db builds database from DATA_CSV.
+        """
+        path = os.path.join(self.tmpdir, 'init.db')
+        main.app.config.update(DATA_CSV=TEST_DATA_CSV, DATA_DB=path)
+        main.init_db()
+        self.assertEqual(database.SqliteStore(path).rows(), 9)
+
+
+class PresenceAnalyzerImporterTestCase(unittest.TestCase):
+    """
+    Bulk import tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_split(self):
+        """
+        Test file is split at line boundaries.
+        """
+        chunks = importer.split(self.path, 40)
+        self.assertEqual(chunks[0], (0, 66))
+        self.assertEqual(chunks[-1][1], os.path.getsize(self.path))
+        with open(self.path, 'rb') as csvfile:
+            content = csvfile.read()
+        for start, end in chunks[:-1]:
+            self.assertEqual(content[end - 1], '\n')
+        self.assertEqual(importer.split(self.path), [(0, len(content))])
+
+    def test_import_csv(self):
+        """
+        Test parallel import gives the same store as loading file.
+        """
+        expected = store.PresenceStore.from_csv(self.path)
+        for processes in (1, 2):
+            data, duplicates = importer.import_csv(self.path,
+                                                   processes=processes,
+                                                   chunk_size=40)
+            self.assertEqual(duplicates, 0)
+            self.assertEqual(data.to_dict(), expected.to_dict())
+            self.assertEqual(data.summaries, expected.summaries)
+            self.assertEqual(data.source.offset, expected.source.offset)
+            self.assertEqual(data.source.tail, expected.source.tail)
+
+    def test_import_csv_appended(self):
+        """
+        Test lines appended during import are left for update.
+        """
+        parse_chunk = importer.parse_chunk
+        self.addCleanup(setattr, importer, 'parse_chunk', parse_chunk)
+
+        def appending_parse_chunk(job):
+            with open(self.path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            importer.parse_chunk = parse_chunk
+            return parse_chunk(job)
+
+        importer.parse_chunk = appending_parse_chunk
+        data, __ = importer.import_csv(self.path, processes=1)
+        self.assertNotIn(12, data)
+        self.assertIn(12, data.update_from_csv(self.path))
+
+        data, __ = importer.import_csv(self.path, index=False)
+        self.assertEqual(data.summaries, {})
+        self.assertIn(12, data)
+
+    def test_conflict_rules(self):
+        """
+        Test resolving entries of the same user and day.
+        """
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n10,2013-09-10,08:00:00,19:00:00\n'
+                          '10,2013-09-10,10:00:00,11:00:00\n')
+        expected = {
+            'first': (34745, 64792),
+            'last': (36000, 39600),
+            'longest': (28800, 68400),
+        }
+        for rule, (start, end) in expected.iteritems():
+            data, duplicates = importer.import_csv(self.path, rule,
+                                                   chunk_size=40)
+            self.assertEqual(duplicates, 2)
+            self.assertEqual(list(data[10])[0][1:], (start, end))
+        self.assertRaises(importer.DuplicateEntryError, importer.import_csv,
+                          self.path, 'error')
+        self.assertRaises(ValueError, importer.import_csv, self.path, 'any')
+
+    def test_import_data(self):
+        """
+        Test importing into snapshot and SQLite database.
+        """
+        rows, duplicates, target = main.import_data(self.path)
+        self.assertEqual((rows, duplicates), (9, 0))
+        self.assertEqual(target, snapshot.snapshot_path(self.path))
+        self.assertEqual(snapshot.load(target, self.path).rows(), 9)
+
+        db_path = os.path.join(self.tmpdir, 'presence.db')
+        main.app.config.update(DATA_BACKEND='sqlite', DATA_DB=db_path)
+        self.addCleanup(main.app.config.update, DATA_BACKEND='csv')
+        self.assertEqual(main.import_data(self.path), (9, 0, db_path))
+        self.assertEqual(database.SqliteStore(db_path).to_dict(),
+                         store.PresenceStore.from_csv(self.path).to_dict())
+
+
+class PresenceAnalyzerPartitionsTestCase(unittest.TestCase):
+    """
+    Partitioned dataset tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        with open(TEST_DATA_CSV) as csvfile:
+            lines = csvfile.read().splitlines()
+        # 2013-09-05 and 2013-09-09 to 2013-09-13 entries
+        self.write('week1.csv', [lines[3]])
+        self.write('week2.csv', lines[:3] + lines[4:])
+        self.loads = []
+        self.expected = store.PresenceStore.from_csv(TEST_DATA_CSV)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, lines):
+        """
+        Writes lines to partition file.
+        """
+        with open(os.path.join(self.tmpdir, name), 'w') as csvfile:
+            csvfile.write('\n'.join(lines) + '\n')
+
+    def loader(self, path):
+        """
+        Counts loads of partitions.
+        """
+        self.loads.append(os.path.basename(path))
+        return store.PresenceStore.from_csv(path)
+
+    def test_init_db_and_import(self):
+        """
+        Test building database and importing data of partition files.
+        """
+        self.addCleanup(main.app.config.update, DATA_BACKEND='csv')
+        path = os.path.join(self.tmpdir, 'presence.db')
+        main.app.config.update(DATA_CSV=self.tmpdir, DATA_DB=path)
+        main.init_db()
+        self.assertEqual(database.SqliteStore(path).to_dict(),
+                         self.expected.to_dict())
+
+        rows, duplicates, targets = main.import_data()
+        self.assertEqual((rows, duplicates), (9, 0))
+        self.assertEqual(targets, [
+            snapshot.snapshot_path(os.path.join(self.tmpdir, name))
+            for name in ('week1.csv', 'week2.csv')
+        ])
+        self.assertEqual(sum(snapshot.load(
+                target, target[:-len(snapshot.SUFFIX)]
+            ).rows()
+                             for target in targets), 9)
+
+        os.unlink(path)
+        main.app.config.update(DATA_BACKEND='sqlite')
+        self.assertEqual(main.import_data(), (9, 0, path))
+        self.assertEqual(database.SqliteStore(path).to_dict(),
+                         self.expected.to_dict())
+
+    def test_partition_paths(self):
+        """
+        Test listing partitions of directories and glob patterns.
+        """
+        self.assertEqual(partitions.partition_paths(TEST_DATA_CSV), None)
+        names = [os.path.join(self.tmpdir, name)
+                 for name in ('week1.csv', 'week2.csv')]
+        self.assertEqual(partitions.partition_paths(self.tmpdir), names)
+        self.assertEqual(partitions.partition_paths(
+            os.path.join(self.tmpdir, '*2.csv')
+        ), names[1:])
+        # snapshots and manifest written next to partitions are skipped
+        partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.write('week1.csv.snapshot', [])
+        self.assertEqual(partitions.partition_paths(
+            os.path.join(self.tmpdir, '*')
+        ), names)
+        self.assertEqual(partitions.partition_paths(
+            os.path.join(self.tmpdir, '.*')
+        ), [])
+
+        signature = partitions.dataset_signature(self.tmpdir)
+        self.write('week3.csv', [])
+        self.assertNotEqual(partitions.dataset_signature(self.tmpdir),
+                            signature)
+
+    def test_store(self):
+        """
+        Test partitioned store gives the same results as single file.
+        """
+        data = partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.assertTrue(data.disjoint)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data.rows(), 9)
+        self.assertIn(11, data)
+        self.assertNotIn(12, data)
+        self.assertEqual(data.to_dict(), self.expected.to_dict())
+        for first, last in ((None, None), (735117, 735121), (735119, None)):
+            self.assertEqual(data.user_ids(first, last),
+                             self.expected.user_ids(first, last))
+            self.assertEqual(data.summaries_of([10, 11], first, last),
+                             self.expected.summaries_of([10, 11], first,
+                                                        last))
+            self.assertEqual(data.quantiles_of([10, 11], first, last),
+                             self.expected.quantiles_of([10, 11], first,
+                                                        last))
+
+    def test_lazy_loading(self):
+        """
+        Test partitions are loaded only when needed and manifest is reused.
+        """
+        partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.assertEqual(sorted(self.loads), ['week1.csv', 'week2.csv'])
+
+        self.loads = []
+        self.write('week1.csv', ['11,2013-09-06,09:00:00,17:00:00'])
+        data = partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.assertEqual(self.loads, ['week1.csv'])
+        self.assertEqual(data.user_ids(735117, 735118), [11])
+        self.assertEqual(self.loads, ['week1.csv'])
+
+        # users of partitions entirely in range are read from manifest
+        data = partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.assertEqual(data.user_ids(735117, 735118), [11])
+        self.assertEqual(self.loads, ['week1.csv'])
+        self.assertEqual(data.summary(11).counts[4], 2)
+        self.assertEqual(self.loads, ['week1.csv', 'week1.csv', 'week2.csv'])
+
+    def test_removed_partitions(self):
+        """
+        Test entries of removed partitions are dropped from manifest.
+        """
+        manifest = partitions.manifest_path(self.tmpdir)
+        self.write('other.txt', ['11,2013-09-06,09:00:00,17:00:00'])
+        partitions.PartitionedStore.open(os.path.join(self.tmpdir, '*.txt'),
+                                         self.loader)
+        partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.assertEqual(sorted(partitions.read_manifest(manifest)),
+                         ['other.txt', 'week1.csv', 'week2.csv'])
+
+        os.unlink(os.path.join(self.tmpdir, 'week1.csv'))
+        data = partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.assertEqual(data.rows(), 8)
+        # entries of other patterns sharing the manifest are kept
+        self.assertEqual(sorted(partitions.read_manifest(manifest)),
+                         ['other.txt', 'week2.csv'])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['.manifest.json', 'other.txt', 'week2.csv'])
+
+    def test_prefork_preload(self):
+        """
+        Test pre-fork master loads all partitions before forking workers.
+        """
+        partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.loads = []
+        parts = cache.DatasetCache(self.loader)
+        datasets = cache.DatasetCache(
+            lambda path: partitions.PartitionedStore.open(path, parts.get),
+            signature=partitions.dataset_signature,
+        )
+        master = prefork.Master(main.app, datasets, self.tmpdir, 2, 1, parts)
+        master.entry = datasets.get_entry(self.tmpdir)
+        self.assertEqual(self.loads, [])
+        master.preload()
+        self.assertEqual(sorted(self.loads), ['week1.csv', 'week2.csv'])
+        self.assertEqual(master.preloaded, sorted(parts.load_times))
+
+    def test_overlapping(self):
+        """
+        Test entries of later partitions replace entries of the same day.
+        """
+        self.write('week3.csv', ['10,2013-09-10,09:00:00,17:00:00'])
+        data = partitions.PartitionedStore.open(self.tmpdir, self.loader)
+        self.assertFalse(data.disjoint)
+        self.assertEqual(data[10].starts[0], 9 * 3600)
+        self.assertEqual(data.summary(10).start_totals[1], 9 * 3600)
+        self.assertEqual(len(data[10]), 3)
+
+    def test_views(self):
+        """
+        Test views served from partitioned dataset.
+        """
+        main.app.config.update(DATA_CSV=self.tmpdir)
+        self.addCleanup(main.app.config.update, DATA_CSV=TEST_DATA_CSV)
+        client = main.app.test_client()
+        resp = client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(json.loads(resp.data)[1], [u'Tue', 30047.0])
+        resp = client.get('/api/v1/users?from=2013-09-05&to=2013-09-06')
+        self.assertEqual(json.loads(resp.data),
+                         [{u'user_id': 11, u'name': u'User 11'}])
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.snapshot = snapshot.snapshot_path(self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def assertStoreEqual(self, first, second):
+        """
+        Checks stores contain the same entries and summaries.
+        """
+        self.assertEqual(first.to_dict(), second.to_dict())
+        self.assertEqual(first.user_ids(), second.user_ids())
+        for user_id in first.user_ids():
+            self.assertEqual(first.summary(user_id), second.summary(user_id))
+
+    def test_write_load(self):
+        """
+        Test store survives round trip through snapshot file.
+        """
+        data = store.PresenceStore.from_csv(self.path)
+        snapshot.write(data, self.snapshot, self.path)
+        loaded = snapshot.load(self.snapshot, self.path)
+        self.assertStoreEqual(loaded, data)
+        self.assertEqual(loaded.source.offset, data.source.offset)
+        self.assertEqual(loaded.source.tail, data.source.tail)
+        self.assertEqual(loaded.quantiles, {})
+        self.assertEqual(loaded.quantiles_of(data.user_ids()),
+                         data.quantiles_of(data.user_ids()))
+        self.assertItemsEqual(loaded.quantiles, data.user_ids())
+
+    def test_load_missing(self):
+        """
+        Test missing and broken snapshots are ignored.
+        """
+        self.assertIsNone(snapshot.load(self.snapshot, self.path))
+        with open(self.snapshot, 'wb') as output:
+            output.write('broken')
+        self.assertIsNone(snapshot.load(self.snapshot, self.path))
+
+    def test_load_changed_source(self):
+        """
+        Test snapshot is rejected when CSV file was rewritten.
+        """
+        snapshot.write(store.PresenceStore.from_csv(self.path),
+                       self.snapshot, self.path)
+        with open(self.path, 'r+') as csvfile:
+            csvfile.write('12')
+        os.utime(self.path, (0, 0))
+        self.assertIsNone(snapshot.load(self.snapshot, self.path))
+
+    def test_load_or_build(self):
+        """
+        Test snapshot is generated and refreshed with appended lines.
+        """
+        built = snapshot.load_or_build(self.path)
+        self.assertTrue(os.path.exists(self.snapshot))
+        self.assertStoreEqual(snapshot.load_or_build(self.path), built)
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        updated = snapshot.load_or_build(self.path)
+        self.assertIn(12, updated)
+        self.assertStoreEqual(updated,
+                              store.PresenceStore.from_csv(self.path))
+        self.assertStoreEqual(snapshot.load(self.snapshot, self.path),
+                              updated)
+
+
+class PresenceAnalyzerCacheTestCase(unittest.TestCase):
+    """
+    Dataset cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.loads = []
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def loader(self, path):
+        """
+        Counts loads and returns fresh object for each of them.
+        """
+        self.loads.append(path)
+        return object()
+
+    def test_get_cached(self):
+        """
+        Test dataset is loaded once while file is unchanged.
+        """
+        datasets = cache.DatasetCache(self.loader)
+        first = datasets.get(self.path)
+        self.assertIs(datasets.get(self.path), first)
+        self.assertEqual(len(self.loads), 1)
+
+    def test_get_reloads_changed_file(self):
+        """
+        Test dataset is reloaded after file changes.
+        """
+        datasets = cache.DatasetCache(self.loader)
+        first = datasets.get(self.path)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,17:00:00\n')
+        self.assertIsNot(datasets.get(self.path), first)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_get_watched(self):
+        """
+        Test watched datasets are only reloaded by refresh().
+        """
+        datasets = cache.DatasetCache(self.loader)
+        datasets.watched.add(self.path)
+        first = datasets.get(self.path)
+        self.assertIn(self.path, datasets.load_times)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,17:00:00\n')
+        self.assertIs(datasets.get(self.path), first)
+        second = datasets.refresh(self.path).value
+        self.assertIsNot(second, first)
+        self.assertIs(datasets.get(self.path), second)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_retain(self):
+        """
+        Test dropping datasets of other paths.
+        """
+        datasets = cache.DatasetCache(self.loader)
+        datasets.get(self.path)
+        datasets.watched.add(self.path)
+        datasets.retain([self.path])
+        self.assertIn(self.path, datasets.load_times)
+        datasets.retain([])
+        self.assertEqual(datasets.load_times, {})
+        self.assertEqual(datasets.watched, set())
+        datasets.get(self.path)
+        self.assertEqual(len(self.loads), 2)
+
+    def test_executor(self):
+        """
+        Test datasets are loaded with executor, if set.
+        """
+        calls = []
+
+        def executor(function, args):
+            calls.append(function)
+            return function(*args)
+
+        datasets = cache.DatasetCache(self.loader)
+        datasets.set_executor(executor)
+        datasets.get(self.path)
+        datasets.get(self.path)
+        self.assertEqual(calls, [datasets._refresh])
+        self.assertEqual(len(self.loads), 1)
+
+    def test_refresher(self):
+        """
+        Test refresher reloads changed file in background.
+        """
+        datasets = cache.DatasetCache(self.loader)
+        thread = refresher.Refresher(datasets, self.path, 0.01)
+        self.assertFalse(thread.health()['healthy'])
+        thread.start()
+        self.addCleanup(thread.stop)
+        while len(self.loads) < 1:
+            time.sleep(0.01)
+        self.assertIn(self.path, datasets.watched)
+        first = datasets.get(self.path)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,17:00:00\n')
+        while len(self.loads) < 2:
+            time.sleep(0.01)
+        self.assertIsNot(datasets.get(self.path), first)
+        health = thread.health()
+        self.assertTrue(health['healthy'])
+        self.assertEqual(health['last_load'], datasets.load_times[self.path])
+
+        os.unlink(self.path)
+        self.assertFalse(thread.refresh())
+        self.assertFalse(thread.health()['healthy'])
+        self.assertTrue(thread.health()['last_error'].startswith('OSError'))
+        thread.stop()
+        self.assertNotIn(self.path, datasets.watched)
+
+    def test_get_concurrent(self):
+        """
+        Test concurrent requests trigger single load.
+        """
+        datasets = cache.DatasetCache(self.loader)
+        threads = [threading.Thread(target=datasets.get, args=(self.path,))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.loads), 1)
+
+    def test_update_from_csv(self):
+        """
+        Test appended lines are loaded incrementally.
+        """
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n')
+        data = store.PresenceStore.from_csv(self.path)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('11,2013-09-25,09:00:00,17:00:00\n'
+                          '11,2013-09-05,10:00:00,16:00:00\n'
+                          '12,2013-09-10,09:00:00,17:00:00\n'
+                          '10,2013-09-20,08:00:00,')
+        data.quantiles_of(data.user_ids())
+        updated = data.update_from_csv(self.path)
+        expected = store.PresenceStore.from_csv(self.path)
+        self.assertEqual(data.user_ids(), [10, 11])
+        self.assertEqual(updated.user_ids(), [10, 11, 12])
+        self.assertEqual(updated.to_dict(), expected.to_dict())
+        for user_id in updated.user_ids():
+            self.assertEqual(updated.summary(user_id),
+                             aggregates.summarize(updated[user_id]))
+        # sketch of user 11, whose entries were merged, is built again
+        self.assertEqual(sorted(updated.quantiles), [10])
+        self.assertEqual(updated.quantiles_of(updated.user_ids()),
+                         quantiles.sketch_many(updated.users))
+        self.assertIs(updated[10], data[10])
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('16:00:00\n')
+        updated = updated.update_from_csv(self.path)
+        self.assertEqual(updated.to_dict(),
+                         store.PresenceStore.from_csv(self.path).to_dict())
+        self.assertEqual(updated.summary(10),
+                         aggregates.summarize(updated[10]))
+        self.assertEqual(updated.quantiles[10],
+                         quantiles.sketch(updated[10]))
+
+    def test_update_from_csv_truncated(self):
+        """
+        Test rewritten file is not loaded incrementally.
+        """
+        data = store.PresenceStore.from_csv(self.path)
+        with open(self.path, 'r+') as csvfile:
+            csvfile.write('12')
+        self.assertIsNone(data.update_from_csv(self.path))
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,17:00:00\n')
+        self.assertIsNone(data.update_from_csv(self.path))
+
+    def test_get_updates_changed_file(self):
+        """
+        Test dataset is updated incrementally when updater is given.
+        """
+        datasets = cache.DatasetCache(store.PresenceStore.from_csv,
+                                      store.PresenceStore.update_from_csv)
+        first = datasets.get(self.path)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        updated = datasets.get(self.path)
+        self.assertIn(12, updated)
+        self.assertIs(updated[10], first[10])
+
+    def test_response_cache_lru(self):
+        """
+        Test least recently used responses are evicted.
+        """
+        version = ('data.csv', 1)
+        responses = cache.ResponseCache(2, 100)
+        responses.set('a', 'first', version)
+        responses.set('b', 'second', version)
+        self.assertEqual(responses.get('a', version), 'first')
+        responses.set('c', 'third', version)
+        self.assertIsNone(responses.get('b', version))
+        self.assertEqual(responses.get('c', version), 'third')
+        self.assertEqual(responses.stats(),
+                         {'entries': 2, 'bytes': 10, 'hits': 2, 'misses': 1})
+
+    def test_response_cache_limits(self):
+        """
+        Test size limit and dataset version invalidation.
+        """
+        first, second = ('data.csv', 1), ('data.csv', 2)
+        responses = cache.ResponseCache(10, 10)
+        responses.set('a', 'x' * 11, first)
+        self.assertEqual(len(responses), 0)
+        responses.set('a', 'x' * 6, first)
+        responses.set('b', 'x' * 6, first)
+        self.assertIsNone(responses.get('a', first))
+        self.assertEqual(responses.size, 6)
+        self.assertIsNone(responses.get('b', second))
+        self.assertEqual(len(responses), 0)
+
+    def test_response_cache_stale(self):
+        """
+        Test requests of older dataset versions do not clear the cache.
+        """
+        first, second = ('data.csv', 1), ('data.csv', 2)
+        responses = cache.ResponseCache(10, 100)
+        responses.set('a', 'new', second)
+        responses.set('a', 'old', first)
+        self.assertIsNone(responses.get('a', first))
+        self.assertEqual(responses.get('a', second), 'new')
+        self.assertEqual(responses.version, second)
+        # other dataset replaces entries, whatever its generation
+        other = ('other.csv', 0)
+        self.assertIsNone(responses.get('a', other))
+        self.assertEqual(len(responses), 0)
+        responses.set('a', 'other', other)
+        self.assertEqual(responses.get('a', other), 'other')
+
+    def test_get_response_cache(self):
+        """
+        Test API responses are served from cache.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        responses = utils.get_response_cache()
+        responses.clear()
+        client = main.app.test_client()
+        first = client.get('/api/v1/presence_weekday/11').data
+        self.assertEqual(client.get('/api/v1/presence_weekday/11').data,
+                         first)
+        self.assertEqual(responses.hits, 1)
+        self.assertEqual(responses.misses, 1)
+
+    def test_get_response_cache_older_mtime(self):
+        """
+        Test responses are cached for datasets replaced with older files.
+        """
+        main.app.config.update({'DATA_CSV': self.path})
+        responses = utils.get_response_cache()
+        responses.clear()
+        client = main.app.test_client()
+        first = client.get('/api/v1/users').data
+        stat = os.stat(self.path)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+        os.utime(self.path, (stat.st_atime, stat.st_mtime - 60))
+        second = client.get('/api/v1/users').data
+        self.assertNotEqual(second, first)
+        self.assertEqual(client.get('/api/v1/users').data, second)
+        self.assertEqual(responses.hits, 1)
+        self.assertEqual(responses.misses, 2)
+
+    def test_get_store_cached(self):
+        """
+        Test get_store serves parsed data from memory.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.assertIs(utils.get_store(), utils.get_store())
+
+    def test_prefork_gc(self):
+        """
+        Test full collections are made rarer in workers without gc.freeze().
+        """
+        threshold = prefork.gc.get_threshold()
+        self.addCleanup(prefork.gc.set_threshold, *threshold)
+        prefork.tune_gc()
+        if hasattr(prefork.gc, 'freeze'):
+            self.assertEqual(prefork.gc.get_threshold(), threshold)
+        else:
+            self.assertEqual(prefork.gc.get_threshold()[2],
+                             threshold[2] * prefork.FULL_COLLECTION_FACTOR)
+
+    def test_prefork_reload(self):
+        """
+        Test pre-fork master replaces workers when data file changes.
+        """
+        datasets = cache.DatasetCache(self.loader)
+        master = prefork.Master(main.app, datasets, self.path, 2, 1)
+        master.entry = datasets.get_entry(self.path)
+        generations = []
+        master.spawn_generation = lambda: generations.append(master.entry)
+        master.reload()
+        self.assertEqual(generations, [])
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('12,2013-09-10,09:00:00,17:00:00\n')
+        master.reload()
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual(generations, [datasets.get_entry(self.path)])
+        master.reload(force=True)
+        self.assertEqual(len(generations), 2)
+        self.assertEqual(len(self.loads), 2)
+
+
+@unittest.skipUnless(gevent_server.available(), 'gevent is not installed')
+class PresenceAnalyzerGeventTestCase(unittest.TestCase):
+    """
+    gevent serving mode tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.calls = []
+        self.threads = set()
+        for datasets in (utils.DATASETS, utils.PARTITIONS):
+            datasets.clear()
+            datasets.set_executor(self.executor)
+        main.app.config.update(RESPONSE_CACHE_SIZE=0)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        for datasets in (utils.DATASETS, utils.PARTITIONS):
+            datasets.set_executor(None)
+            datasets.clear()
+        main.app.config.update(DATA_BACKEND='csv', DATA_CSV=TEST_DATA_CSV,
+                               RESPONSE_CACHE_SIZE=1024)
+        shutil.rmtree(self.tmpdir)
+
+    def executor(self, function, args):
+        """
+        Runs function in gevent's pool of threads, recording the call.
+        """
+        def call(*args):
+            self.threads.add(threading.current_thread().ident)
+            return function(*args)
+        self.calls.append(function)
+        return gevent_server.in_threadpool(call, args)
+
+    def get(self, url):
+        """
+        Serves single request with gevent's server, returns its status code.
+        """
+        import gevent.pywsgi
+        import gevent.socket
+        server = gevent.pywsgi.WSGIServer(('127.0.0.1', 0), main.app,
+                                          log=None)
+        server.start()
+        try:
+            client = gevent.socket.create_connection(server.address)
+            client.sendall('GET {0} HTTP/1.0\r\n\r\n'.format(url))
+            response = ''
+            chunk = client.recv(4096)
+            while chunk:
+                response += chunk
+                chunk = client.recv(4096)
+            client.close()
+        finally:
+            server.stop()
+        return int(response.split(' ', 2)[1])
+
+    def test_contended_reload(self):
+        """
+        Test greenlet and thread of the pool waiting for the same reload.
+        """
+        import gevent
+        import gevent.monkey
+        native_lock = gevent.monkey.get_original('thread', 'allocate_lock')
+        lockers = []
+
+        class Lock(object):
+            """
+            Lock of native threads recording threads taking it.
+            """
+            def __init__(self):
+                self.lock = native_lock()
+
+            def __enter__(self):
+                lockers.append(threading.current_thread().ident)
+                self.lock.acquire()
+
+            def __exit__(self, *args):
+                self.lock.release()
+
+        def loader(path):
+            self.calls.append(path)
+            time.sleep(0.1)
+            return object()
+
+        path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        datasets = cache.DatasetCache(loader)
+        datasets.set_executor(gevent_server.in_threadpool, Lock)
+        loading = gevent.spawn(datasets.get, path)
+        gevent.sleep(0.02)
+        value = gevent_server.in_threadpool(datasets.get, (path,))
+        self.assertIs(loading.get(), value)
+        self.assertEqual(self.calls, [path])
+        self.assertNotIn(threading.current_thread().ident, lockers)
+
+    def test_sqlite_queries(self):
+        """
+        Test SQLite queries of requests run in the pool of threads.
+        """
+        path = os.path.join(self.tmpdir, 'presence.db')
+        database.build_database(TEST_DATA_CSV, path)
+        main.app.config.update(DATA_BACKEND='sqlite', DATA_DB=path)
+        self.assertEqual(self.get('/api/v1/mean_time_weekday/10'), 200)
+        self.assertEqual(self.calls[0], utils.DATASETS._refresh)
+        self.assertIn('_fetch', [call.__name__ for call in self.calls])
+        self.assertNotIn(threading.current_thread().ident, self.threads)
+
+    def test_partition_loads(self):
+        """
+        Test partitions loaded by requests are parsed in the pool of threads.
+        """
+        shutil.copy(TEST_DATA_CSV, os.path.join(self.tmpdir, 'week.csv'))
+        main.app.config.update(DATA_CSV=self.tmpdir)
+        # partitions listed in manifest are loaded only when requested
+        self.assertEqual(self.get('/api/v1/users'), 200)
+        utils.DATASETS.clear()
+        utils.PARTITIONS.clear()
+        del self.calls[:]
+        self.assertEqual(self.get('/api/v1/users'), 200)
+        self.assertEqual(self.calls, [utils.DATASETS._refresh])
+        self.assertEqual(self.get('/api/v1/mean_time_weekday/10'), 200)
+        self.assertEqual(self.calls, [utils.DATASETS._refresh,
+                                      utils.PARTITIONS._refresh])
+        self.assertNotIn(threading.current_thread().ident, self.threads)
+
+
 def suite():
     """
     Default test suite.
@@ -297,6 +1960,20 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerParserTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAggregatesTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerTeamTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerOccupancyTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerQuantilesTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerInstrumentationTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSerializersTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerDatabaseTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerImporterTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerPartitionsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerCacheTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerGeventTestCase))
     return suite
 
 
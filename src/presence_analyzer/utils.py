@@ -3,33 +3,241 @@
 Helper functions used in views.
 """
 
-import csv
-from json import dumps
+import hashlib
+import calendar
 from functools import wraps
 from datetime import datetime
 
-from flask import Response
+from flask import Response, request, g, has_request_context, abort
+from werkzeug.http import is_resource_modified
 
 from presence_analyzer.main import app
+from presence_analyzer.cache import DatasetCache, ResponseCache
+from presence_analyzer.store import PresenceStore, UserPresence
+from presence_analyzer.database import SqliteStore
+from presence_analyzer.partitions import (PartitionedStore, partition_paths,
+                                          dataset_signature)
+from presence_analyzer import snapshot, serializers
+from presence_analyzer.instrumentation import timed
+from presence_analyzer.refresher import Refresher
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 
+# content encodings of compressed responses, in order of preference
+COMPRESSED_ENCODINGS = ('gzip', 'deflate')
+
+# header row of presence_weekday()
+WEEKDAY_HEADER = ('Weekday', 'Presence (s)')
+
+
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Responses carry ETag header derived from version of the dataset, so
+    conditional requests for unchanged data are answered with 304. Such
+    answer is given only once the response is known to succeed: its body is
+    in response cache or wrapped function returned, validating its
+    arguments. Last-Modified is not sent, as modification times of data
+    files may move backwards and HTTP dates cannot tell apart changes made
+    within a second. Serialized results are kept in response cache
+    until the dataset changes. Bodies of at least RESPONSE_COMPRESS_MIN_SIZE
+    bytes are compressed for clients accepting it, compressed bodies are
+    cached as well.
+
+    Time spent in wrapped function and serialization is reported as
+    `aggregate` and `serialize` request phases.
     """
     @wraps(function)
     def inner(*args, **kwargs):
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        dataset = get_dataset()
+        key = (request.endpoint, request.full_path)
+        version = (get_data_path(), dataset.generation)
+
+        responses = get_response_cache()
+        body = responses.get(key, version)
+        if body is None:
+            with timed('aggregate'):
+                result = function(*args, **kwargs)
+            with timed('serialize'):
+                body = serializers.dumps(result, get_json_encoder())
+            responses.set(key, body, version)
+
+        encoding = get_accepted_encoding()
+        if (encoding is not None and
+                len(body) < app.config['RESPONSE_COMPRESS_MIN_SIZE']):
+            encoding = None
+        # every representation of the response, as sent, has its own ETag
+        etag = hashlib.md5(repr((key, get_data_path(), dataset.signature,
+                                 encoding))).hexdigest()
+
+        if not is_resource_modified(request.environ, etag=etag):
+            response = Response(status=304, mimetype='application/json')
+        else:
+            if encoding is not None:
+                compressed_key = key + (encoding,)
+                compressed = responses.get(compressed_key, version)
+                if compressed is None:
+                    with timed('compress'):
+                        compressed = serializers.compress(body, encoding)
+                    responses.set(compressed_key, compressed, version)
+                body = compressed
+            response = Response(body, mimetype='application/json')
+            if encoding is not None:
+                response.content_encoding = encoding
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['API_CACHE_MAX_AGE']
+        if app.config['RESPONSE_COMPRESS_MIN_SIZE'] is not None:
+            response.vary.add('Accept-Encoding')
+        return response
     return inner
 
 
+def get_json_encoder():
+    """
+    Returns JSON encoding function chosen with JSON_ENCODER setting.
+    """
+    encoder = app.extensions.get('json_encoder')
+    name = app.config['JSON_ENCODER']
+    if encoder is None or encoder[0] != name:
+        encoder = app.extensions['json_encoder'] = (
+            name, serializers.get_encoder(name)
+        )
+    return encoder[1]
+
+
+def get_accepted_encoding():
+    """
+    Returns content encoding for compressed responses accepted by client,
+    or None when it accepts none or compression is disabled.
+    """
+    if app.config['RESPONSE_COMPRESS_MIN_SIZE'] is None:
+        return None
+    return request.accept_encodings.best_match(COMPRESSED_ENCODINGS)
+
+
+def get_list_arg(name):
+    """
+    Returns values of query parameter given repeatedly or comma separated.
+    """
+    return [value
+            for values in request.args.getlist(name)
+            for value in values.split(',')
+            if value]
+
+
+def get_day_arg(name):
+    """
+    Returns ordinal of `YYYY-MM-DD` date given in query parameter or None.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+    except ValueError:
+        raise abort(400)
+
+
+def get_date_range():
+    """
+    Returns (first, last) day ordinals from `from` and `to` query parameters.
+
+    Both dates are inclusive, missing ones are returned as None.
+    """
+    return get_day_arg('from'), get_day_arg('to')
+
+
+def get_user_ids(data):
+    """
+    Returns list of user ids from `user_id` query parameter.
+
+    Parameter can be given repeatedly, as comma separated list or as `all`.
+    """
+    user_ids = get_list_arg('user_id')
+    if 'all' in user_ids:
+        return data.user_ids()
+    try:
+        return [int(user_id) for user_id in user_ids]
+    except ValueError:
+        raise abort(400)
+
+
+def get_selected_user_ids(data):
+    """
+    Returns ids of users selected with `user_id` query parameter (all users
+    by default) which have entries, checked with a single store call.
+    """
+    user_ids = get_user_ids(data)
+    if not user_ids:
+        return data.user_ids()
+    return data.known_user_ids(user_ids)
+
+
+def get_response_cache():
+    """
+    Returns cache of serialized API responses.
+
+    Cache is created on first use with limits taken from RESPONSE_CACHE_SIZE
+    (amount of entries) and RESPONSE_CACHE_MAX_BYTES settings.
+    """
+    responses = app.extensions.get('response_cache')
+    if responses is None:
+        responses = app.extensions['response_cache'] = ResponseCache(
+            app.config['RESPONSE_CACHE_SIZE'],
+            app.config['RESPONSE_CACHE_MAX_BYTES'],
+        )
+    return responses
+
+
+# settings holding path of data file of each DATA_BACKEND
+DATA_PATHS = {
+    'csv': 'DATA_CSV',
+    'sqlite': 'DATA_DB',
+}
+
+
+def get_data_path():
+    """
+    Returns path of data file of configured DATA_BACKEND.
+    """
+    return app.config[DATA_PATHS[app.config['DATA_BACKEND']]]
+
+
+def get_dataset():
+    """
+    Returns CacheEntry of dataset built from data file.
+
+    Within a request the same entry is returned on every call, even if
+    data file changes in the meantime. Time spent getting it is reported as
+    `load` request phase.
+    """
+    if not has_request_context():
+        return DATASETS.get_entry(get_data_path())
+    if 'dataset' not in g:
+        with timed('load'):
+            g.dataset = DATASETS.get_entry(get_data_path())
+    return g.dataset
+
+
+def get_store():
+    """
+    Returns presence store built from data file.
+
+    Store is built once and kept in memory until data file changes, so it
+    is shared between requests and must not be modified. Stores of all
+    backends provide the same interface as PresenceStore, which holds
+    all entries of CSV file in memory.
+    """
+    return get_dataset().value
+
+
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Returns presence data grouped by user_id.
 
     It creates structure like this:
     data = {
@@ -44,26 +252,164 @@ def get_data():
             },
         }
     }
+
+    Structure is materialized from the store on every call, views should use
+    get_store() instead.
+    """
+    return get_store().to_dict()
+
+
+def load_csv(path):
+    """
+    Loads presence store from CSV file.
+
+    When DATA_SNAPSHOT is enabled store is read from binary snapshot of the
+    file, which is generated on first load and shared by all processes.
+    """
+    if app.config.get('DATA_SNAPSHOT'):
+        return snapshot.load_or_build(path)
+    return PresenceStore.from_csv(path)
+
+
+def load_store(path):
+    """
+    Loads presence store from data file of DATA_BACKEND.
+
+    SQLite databases are queried by SqliteStore when data is needed. CSV
+    files are loaded into memory; DATA_CSV pointing to a directory or glob
+    pattern is read by PartitionedStore, which loads partition files only
+    when their entries are needed.
+
+    Queries of SqliteStore run with executor of DATASETS, like loading of
+    datasets, so they do not block serving greenlets in gevent mode.
+    """
+    if app.config['DATA_BACKEND'] == 'sqlite':
+        return SqliteStore(path, DATASETS.executor)
+    paths = partition_paths(path)
+    if paths is not None:
+        store = PartitionedStore.open(path, PARTITIONS.get)
+        # forget partitions which were removed
+        PARTITIONS.retain(paths)
+        return store
+    return load_csv(path)
+
+
+def update_store(store, path):
+    """
+    Returns store extended with lines appended to CSV file, or None when
+    it has to be loaded from scratch.
+    """
+    if isinstance(store, PresenceStore):
+        return store.update_from_csv(path)
+    return None
+
+
+DATASETS = DatasetCache(load_store, update_store, dataset_signature)
+
+# partitions are cached separately, so unchanged ones are not parsed again
+# when other partitions change
+PARTITIONS = DatasetCache(load_csv, update_store)
+
+
+def start_refresher():
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    Starts reloading data file in background every DATA_REFRESH_INTERVAL
+    seconds, unless the interval is 0.
+
+    Returns the Refresher, if any.
+    """
+    interval = app.config['DATA_REFRESH_INTERVAL']
+    refresher = app.extensions.get('refresher')
+    if refresher is None and interval:
+        refresher = app.extensions['refresher'] = Refresher(
+            DATASETS, get_data_path(), interval
+        )
+        refresher.start()
+    return refresher
+
+
+def get_health():
+    """
+    Returns dict describing state of the dataset.
+
+    Without background refresher dataset is loaded if needed and healthy
+    when it could be loaded.
+    """
+    refresher = app.extensions.get('refresher')
+    if refresher is not None:
+        health = refresher.health()
+    else:
+        health = {'healthy': True, 'last_error': None}
+        try:
+            get_dataset()
+        except Exception as error:  # pylint: disable-msg=W0703
+            log.exception('Cannot load dataset')
+            health.update(healthy=False, last_error='{0}: {1}'.format(
+                type(error).__name__, error
+            ))
+        health['last_check'] = health['last_load'] = DATASETS.load_times.get(
+            get_data_path()
+        )
+    health['refresher'] = refresher is not None
+    return health
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def mean_time_weekday(summary):
+    """
+    Returns mean presence time from WeekdaySummary as (weekday, seconds)
+    list.
+    """
+    return [(calendar.day_abbr[weekday], value)
+            for weekday, value in enumerate(summary.mean_intervals())]
 
-    return data
+
+def presence_weekday(summary, header=WEEKDAY_HEADER):
+    """
+    Returns total presence time from WeekdaySummary as (weekday, seconds)
+    list, preceded by header row.
+
+    Header may be given as pre-encoded serializers.Fragment.
+    """
+    result = [(calendar.day_abbr[weekday], value)
+              for weekday, value in enumerate(summary.totals())]
+    result.insert(0, header)
+    return result
+
+
+def presence_start_end(summary):
+    """
+    Returns mean start and end of presence from WeekdaySummary as
+    (weekday, start, end) list.
+    """
+    starts, ends = summary.mean_starts(), summary.mean_ends()
+    return [(calendar.day_abbr[weekday], starts[weekday], ends[weekday])
+            for weekday in range(7)]
+
+
+def presence_percentiles(quantiles):
+    """
+    Returns arrival, departure and interval percentiles in seconds from
+    WeekdayQuantiles as (weekday, percentiles) list.
+    """
+    return [(calendar.day_abbr[weekday], percentiles)
+            for weekday, percentiles in enumerate(quantiles.percentiles())]
+
+
+def weekday_rows(items):
+    """
+    Yields (weekday, start, end) tuples of presence entries, start and end
+    as seconds since midnight.
+
+    Accepts both UserPresence and {date: {'start': time, 'end': time}} dict.
+    """
+    if isinstance(items, UserPresence):
+        return items.weekday_rows()
+    return (
+        (date.weekday(),
+         seconds_since_midnight(entry['start']),
+         seconds_since_midnight(entry['end']))
+        for date, entry in items.iteritems()
+    )
 
 
 def group_by_weekday(items):
@@ -71,10 +417,8 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = {i: [] for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for weekday, start, end in weekday_rows(items):
+        result[weekday].append(end - start)
     return result
 
 
@@ -84,11 +428,9 @@ def group_by_weekday_start_end(items):
     """
     result = {i: {'start': [], 'end': []} for i in range(7)}
 
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()]['start'].append(seconds_since_midnight(start))
-        result[date.weekday()]['end'].append(seconds_since_midnight(end))
+    for weekday, start, end in weekday_rows(items):
+        result[weekday]['start'].append(start)
+        result[weekday]['end'].append(end)
 
     return {i: [mean(result[i]['start']), mean(result[i]['end'])]
             for i in range(7)}
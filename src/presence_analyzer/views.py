@@ -4,18 +4,35 @@ Defines views.
 """
 
 import calendar
-from flask import redirect, render_template, url_for, make_response, abort
+from json import dumps
+from datetime import date, datetime
+
+from flask import (redirect, render_template, url_for, make_response, abort,
+                   request, Response)
 from jinja2 import TemplateNotFound
 
 from presence_analyzer.main import app
-from presence_analyzer.utils import (jsonify, get_data, mean,
-                                     group_by_weekday,
-                                     group_by_weekday_start_end)
+from presence_analyzer.utils import (jsonify, get_store, get_list_arg,
+                                     get_date_range, get_user_ids,
+                                     get_selected_user_ids,
+                                     get_response_cache, get_health,
+                                     mean_time_weekday, presence_weekday,
+                                     presence_start_end,
+                                     presence_percentiles, WEEKDAY_HEADER)
+from presence_analyzer.team import team_statistics
+from presence_analyzer.occupancy import occupancy
+from presence_analyzer.quantiles import WeekdayQuantiles
+from presence_analyzer.serializers import fragment
+from presence_analyzer.instrumentation import (render_metrics,
+                                               PROMETHEUS_MIMETYPE)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 
+WEEKDAY_HEADER_JSON = fragment(WEEKDAY_HEADER)
+
+
 @app.route('/')
 @app.route('/<name>')
 def mainpage(name=None):
@@ -37,9 +54,9 @@ def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
+    data = get_store()
     return [{'user_id': i, 'name': 'User {0}'.format(str(i))}
-            for i in data.keys()]
+            for i in data.user_ids(*get_date_range())]
 
 
 @app.route('/api/v1/mean_time_weekday/', methods=['GET'])
@@ -49,7 +66,7 @@ def mean_time_weekday_view(user_id=None):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
+    data = get_store()
     if not user_id:
         raise abort(400)
 
@@ -57,10 +74,7 @@ def mean_time_weekday_view(user_id=None):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
-    return result
+    return mean_time_weekday(data.summary(user_id, *get_date_range()))
 
 
 @app.route('/api/v1/presence_weekday/', methods=['GET'])
@@ -70,7 +84,7 @@ def presence_weekday_view(user_id=None):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
+    data = get_store()
     if not user_id:
         raise abort(400)
 
@@ -78,12 +92,8 @@ def presence_weekday_view(user_id=None):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(data.summary(user_id, *get_date_range()),
+                            WEEKDAY_HEADER_JSON)
 
 
 @app.route('/api/v1/presence_start_end/', methods=['GET'])
@@ -93,7 +103,7 @@ def presence_start_end_view(user_id=None):
     """
     Returns mean presence time of given user grouped by weekday.
     """
-    data = get_data()
+    data = get_store()
     if not user_id:
         raise abort(400)
 
@@ -101,7 +111,207 @@ def presence_start_end_view(user_id=None):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday_start_end(data[user_id])
-    result = [(calendar.day_abbr[weekday], value[0], value[1])
-              for weekday, value in weekdays.items()]
+    return presence_start_end(data.summary(user_id, *get_date_range()))
+
+
+@app.route('/api/v1/presence_percentiles', methods=['GET'])
+@jsonify
+def presence_percentiles_view():
+    """
+    Returns median, 90th and 95th percentile of arrival, departure and
+    presence time grouped by weekday.
+
+    People are selected with `user_id` parameter (all users by default),
+    sketches of all of them are merged. Percentiles are null for weekdays
+    without entries.
+    """
+    data = get_store()
+    user_ids = get_selected_user_ids(data)
+    merged = WeekdayQuantiles()
+    for quantiles in data.quantiles_of(user_ids,
+                                       *get_date_range()).itervalues():
+        merged.update(quantiles)
+    return presence_percentiles(merged)
+
+
+METRICS = {
+    'mean_time': mean_time_weekday,
+    'presence': presence_weekday,
+    'start_end': presence_start_end,
+}
+
+
+@app.route('/api/v1/batch', methods=['GET'])
+@jsonify
+def batch_view():
+    """
+    Returns weekday statistics of many users at once.
+
+    Users are selected with `user_id` parameter (list of ids or `all`),
+    statistics with `metric` one (any of mean_time, presence, start_end,
+    all of them by default). Like all API views it accepts optional `from`
+    and `to` dates limiting entries taken into account.
+    """
+    data = get_store()
+    user_ids = get_user_ids(data)
+    metrics = get_list_arg('metric') or sorted(METRICS)
+    if not user_ids or any(metric not in METRICS for metric in metrics):
+        raise abort(400)
+
+    summaries = data.summaries_of(data.known_user_ids(user_ids),
+                                  *get_date_range())
+    result = []
+    for user_id in user_ids:
+        entry = {'user_id': user_id}
+        for metric in metrics:
+            if user_id in summaries:
+                entry[metric] = METRICS[metric](summaries[user_id])
+            else:
+                entry[metric] = []
+        result.append(entry)
     return result
+
+
+@app.route('/api/v1/team_weekday', methods=['GET'])
+@jsonify
+def team_weekday_view():
+    """
+    Returns weekday statistics of a team or the whole organization.
+
+    For every weekday returns distribution of users' mean presence time and
+    mean amount of users present in each hour. Team members are selected
+    with `user_id` parameter, all users are taken by default.
+    """
+    data = get_store()
+    user_ids = get_selected_user_ids(data)
+    first, last = get_date_range()
+    presence, headcount = team_statistics(
+        data.summaries_of(user_ids, first, last).values(),
+        data.users_of(user_ids, first, last).values(),
+    )
+    for weekday, distribution in enumerate(presence):
+        distribution['weekday'] = calendar.day_abbr[weekday]
+    return {
+        'presence': presence,
+        'headcount': [(calendar.day_abbr[weekday], hours)
+                      for weekday, hours in enumerate(headcount)],
+    }
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """
+    Returns mean amount of people present in time slots of every weekday.
+
+    Slot length in minutes is given with `slot` parameter (15 by default),
+    people are selected with `user_id` one (all users by default).
+    """
+    data = get_store()
+    users = data.users_of(get_selected_user_ids(data),
+                          *get_date_range()).values()
+    try:
+        slot = int(request.args.get('slot', 15)) * 60
+        if slot <= 0:
+            raise ValueError(slot)
+        result = occupancy(users, slot)
+    except ValueError:
+        raise abort(400)
+
+    return {
+        'slots': ['{0:02d}:{1:02d}'.format(minutes // 60, minutes % 60)
+                  for minutes in range(0, 24 * 60, slot // 60)],
+        'occupancy': [(calendar.day_abbr[weekday], means)
+                      for weekday, means in enumerate(result.means())],
+    }
+
+
+EXPORT_FORMATS = {
+    'ndjson': (
+        'application/x-ndjson',
+        '{{"user_id": {0}, "date": "{1}", "start": "{2}", "end": "{3}"}}\n',
+    ),
+    'csv': (
+        'text/csv',
+        '{0},{1},{2},{3}\n',
+    ),
+}
+
+EXPORT_CHUNK_SIZE = 1000
+
+# users whose entries are read from the store at once
+EXPORT_USER_BATCH = 500
+
+
+def _format_seconds(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def _export(data, user_ids, first, last, line):
+    """
+    Yields chunks of formatted presence entries.
+    """
+    chunk = []
+    for batch in xrange(0, len(user_ids), EXPORT_USER_BATCH):
+        batch_ids = data.known_user_ids(
+            user_ids[batch:batch + EXPORT_USER_BATCH]
+        )
+        users = data.users_of(batch_ids, first, last)
+        for user_id in batch_ids:
+            for day, start, end in users[user_id].entries():
+                chunk.append(line.format(
+                    user_id, date.fromordinal(day).isoformat(),
+                    _format_seconds(start), _format_seconds(end),
+                ))
+                if len(chunk) == EXPORT_CHUNK_SIZE:
+                    yield ''.join(chunk)
+                    chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+@app.route('/api/v1/export.<fmt>', methods=['GET'])
+def export_view(fmt):
+    """
+    Streams raw presence entries as NDJSON or CSV.
+
+    Entries can be limited with `user_id` (list of ids, all users by
+    default), `from` and `to` (inclusive `YYYY-MM-DD` dates) parameters.
+    """
+    if fmt not in EXPORT_FORMATS:
+        return make_response('Not Found', 404)
+    mimetype, line = EXPORT_FORMATS[fmt]
+    data = get_store()
+    user_ids = get_user_ids(data) or data.user_ids()
+    first, last = get_date_range()
+    return Response(_export(data, user_ids, first, last, line),
+                    mimetype=mimetype)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns request timing histograms and response cache counters in
+    Prometheus text format.
+    """
+    return Response(render_metrics(get_response_cache().stats()),
+                    mimetype=PROMETHEUS_MIMETYPE)
+
+
+@app.route('/health', methods=['GET'])
+def health_view():
+    """
+    Returns state of the dataset, with 503 status when it is not healthy.
+
+    Times of last successful load and check of data file are given in UTC.
+    """
+    health = get_health()
+    for key in ('last_load', 'last_check'):
+        if health[key] is not None:
+            health[key] = datetime.utcfromtimestamp(health[key]).isoformat()
+    return Response(dumps(health), status=200 if health['healthy'] else 503,
+                    mimetype='application/json')